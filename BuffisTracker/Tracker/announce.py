@@ -0,0 +1,389 @@
+"""
+The announce path of the tracker. Kept apart from views.py so that tracker-only nodes (see
+tracker_wsgi.py) don't have to import the forms, generic views and auth code of the site. Settings
+are read from the active settings module, so tracker_settings.py can override them for such nodes.
+"""
+
+from socket import inet_aton, inet_ntoa
+from django.conf import settings
+from django.http import HttpResponse
+from django.db import transaction
+from django.db.models import F
+from BuffisTracker.Tracker.models import Torrent, UserProfile
+import BuffisTracker.Tracker.lib.bencode as bencode
+from BuffisTracker.Tracker.lib.shard import ShardClient, get_shard_paths, get_history_path, DEFAULT_TIMEOUT, \
+        DEFAULT_MAX_TABLES, MAX_PORT, MAX_BYTES
+from BuffisTracker.Tracker.lib.peertable import PeerTableReader, peer_table_path
+from BuffisTracker.Tracker.lib.swarm import ABSENT, LEECHER, SEEDER
+from collections import OrderedDict
+import datetime
+import struct
+
+DEFAULT_TORRENT_INTERVAL = 30*60 # 30 minutes
+DEFAULT_TORRENT_MAX_REPLY_PEERS = 50
+DEFAULT_SWARM_SHARDS = 0 # Swarms are kept in the database unless this is set.
+DEFAULT_SWARM_SOCKET_DIR = '/tmp/'
+DEFAULT_SWARM_SOCKET_TIMEOUT = DEFAULT_TIMEOUT
+DEFAULT_PEER_TABLE_DIR = None # Shards only write shared memory peer tables if this is set.
+DEFAULT_PEER_TABLE_MAX_OPEN = DEFAULT_MAX_TABLES
+DEFAULT_SWARM_SNAPSHOT_DIR = None # Shards only save snapshots if this is set.
+DEFAULT_SWARM_SNAPSHOT_INTERVAL = 60
+
+PEER_ID_LENGTH = 20
+
+def get_random_peers(queryset, num_random):
+    import random
+    peers = list(queryset.all())
+    random.shuffle(peers)
+    return peers[:num_random]
+
+_shard_client = None
+
+def get_shard_client():
+    """
+    Returns the ShardClient of this process, creating it on first use.
+    """
+
+    global _shard_client
+    if _shard_client is None:
+        num_shards = getattr(settings, 'SWARM_SHARDS', DEFAULT_SWARM_SHARDS)
+        socket_dir = getattr(settings, 'SWARM_SOCKET_DIR', DEFAULT_SWARM_SOCKET_DIR)
+        timeout = getattr(settings, 'SWARM_SOCKET_TIMEOUT', DEFAULT_SWARM_SOCKET_TIMEOUT)
+        _shard_client = ShardClient(get_shard_paths(socket_dir, num_shards), timeout)
+    return _shard_client
+
+def get_history_client():
+    """
+    Returns a ShardClient for history requests. The history is kept by the shards in sharded mode,
+    and by the runhistory command otherwise.
+    """
+
+    if getattr(settings, 'SWARM_SHARDS', DEFAULT_SWARM_SHARDS):
+        return get_shard_client()
+    return ShardClient([get_history_path(getattr(settings, 'SWARM_SOCKET_DIR', DEFAULT_SWARM_SOCKET_DIR))],
+            getattr(settings, 'SWARM_SOCKET_TIMEOUT', DEFAULT_SWARM_SOCKET_TIMEOUT))
+
+_peer_tables = OrderedDict() # info_hash -> PeerTableReader, least recently used first.
+
+def get_peer_table(info_hash):
+    """
+    Returns a PeerTableReader for a raw info_hash, or None if peer tables are not used or the
+    shard doesn't have a table open for it. Only PEER_TABLE_MAX_OPEN tables are kept open, the
+    least recently used one is closed to make room.
+    """
+
+    table = _peer_tables.pop(info_hash, None)
+    if table is None:
+        table_dir = getattr(settings, 'PEER_TABLE_DIR', DEFAULT_PEER_TABLE_DIR)
+        if not table_dir:
+            return None
+        try:
+            table = PeerTableReader(peer_table_path(table_dir, info_hash))
+        except (EnvironmentError, ValueError, struct.error):
+            return None
+        max_open = getattr(settings, 'PEER_TABLE_MAX_OPEN', DEFAULT_PEER_TABLE_MAX_OPEN)
+        while _peer_tables and len(_peer_tables) >= max_open:
+            _peer_tables.popitem(last=False)[1].close()
+    _peer_tables[info_hash] = table
+    return table
+
+def update_profile(profile, uploaded, downloaded, was, state):
+    """
+    Adds the data transferred by a peer and its move between the seeding/leeching counters to the
+    profile of its user. was and state are the peers state (ABSENT, LEECHER or SEEDER) before and
+    after the announce. Done in a single UPDATE of F() expressions, so that concurrent announces of
+    the same user (and expiries) don't overwrite each others changes.
+    """
+
+    changes = {}
+    if uploaded:
+        changes['uploaded'] = F('uploaded') + uploaded
+    if downloaded:
+        changes['downloaded'] = F('downloaded') + downloaded
+    if was != state:
+        seeding = int(state == SEEDER) - int(was == SEEDER)
+        leeching = int(state == LEECHER) - int(was == LEECHER)
+        if seeding:
+            changes['seeding'] = F('seeding') + seeding
+        if leeching:
+            changes['leeching'] = F('leeching') + leeching
+    if changes:
+        UserProfile.objects.filter(id = profile.id).update(**changes)
+
+def remove_expired_from_user_counts(expired):
+    """
+    Decreases the seeding/leeching counters for expired peers, given as (user id, seeding) pairs.
+    """
+
+    counts = {}
+    for user_id, seeding in expired:
+        counts[(user_id, bool(seeding))] = counts.get((user_id, bool(seeding)), 0) + 1
+    for (user_id, seeding), num in counts.iteritems():
+        if seeding:
+            UserProfile.objects.filter(user = user_id).update(seeding = F('seeding') - num)
+        else:
+            UserProfile.objects.filter(user = user_id).update(leeching = F('leeching') - num)
+
+def resync_user_counts():
+    """
+    Sets the seeding/leeching counters of every user to the peers held by the shards. Peers that a
+    shard loses when it restarts, or drops from its snapshot, are never reported as expired, so this
+    is run whenever shards are started.
+    """
+
+    counts = {}
+    for user_id, seeding, leeching in get_shard_client().user_counts():
+        user_counts = counts.setdefault(user_id, [0, 0])
+        user_counts[0] += seeding
+        user_counts[1] += leeching
+
+    def update():
+        UserProfile.objects.update(seeding = 0, leeching = 0)
+        for user_id, (seeding, leeching) in counts.iteritems():
+            UserProfile.objects.filter(user = user_id).update(seeding = seeding, leeching = leeching)
+    transaction.commit_on_success(update)()
+
+def make_error_response(error_msg):
+    response = bencode.bencode_failure(error_msg)
+    return HttpResponse(response, mimetype="text/plain")
+
+def get_indata_value_error(get_data):
+    """
+    Returns an error message if the peer_id, port, transfer counters or numwant sent by the client
+    are out of range, otherwise None.
+    """
+
+    if len(get_data["peer_id"][0]) != PEER_ID_LENGTH:
+        return "invalid peer id"
+    try:
+        if not 0 <= int(get_data["port"][0]) <= MAX_PORT:
+            return "invalid port"
+        for key in ("uploaded", "downloaded", "left"):
+            if not 0 <= int(get_data[key][0]) <= MAX_BYTES:
+                return "invalid %s" % key
+        if "numwant" in get_data and get_data["numwant"][0] and int(get_data["numwant"][0]) < 0:
+            return "invalid numwant"
+    except ValueError:
+        return "invalid number"
+    return None
+
+def get_max_peers(get_data):
+    """
+    Returns the number of peers the client wants, defaulting to TORRENT_MAX_REPLY_PEERS.
+    """
+
+    if "numwant" in get_data and get_data["numwant"][0]: 
+        return int(get_data["numwant"][0])
+    return getattr(settings, 'TORRENT_MAX_REPLY_PEERS', DEFAULT_TORRENT_MAX_REPLY_PEERS)
+
+def announce_to_shard(torrent, get_data, ip, torrent_pass):
+    """
+    Announce used in sharded mode (SWARM_SHARDS set). The swarm is kept by the shard process owning
+    the info hash (see lib/shard.py), so the only database writes are user accounting and the
+    seeders/leechers counters shown in listings.
+    """
+
+    torrent_interval = getattr(settings, 'TORRENT_INTERVAL', DEFAULT_TORRENT_INTERVAL)
+    info_hash = get_data["info_hash"][0]
+    event = get_data.get("event", [""])[0]
+    compact = "compact" in get_data and get_data["compact"][0]
+    no_peer_id = "no_peer_id" in get_data and get_data["no_peer_id"][0]
+    max_peers = get_max_peers(get_data)
+
+    # The shard leaves out peer ids when they aren't needed. Peer tables don't hold peer ids at all,
+    # so replies with peer ids are always built by the shard. The table is opened before asking the
+    # shard, which only has to send peers when there is no table to read them from.
+    table = None
+    if compact or no_peer_id:
+        table = get_peer_table(info_hash)
+
+    # Check if it is a registered user. The shard binds the user to the peer.
+    profile = None
+    if torrent_pass:
+        try:
+            profile = UserProfile.objects.get(torrent_pass = torrent_pass)
+        except UserProfile.DoesNotExist:
+            pass # Not a registered used, keep going.
+
+    try:
+        reply = get_shard_client().announce(info_hash, get_data["peer_id"][0], inet_aton(ip), 
+                int(get_data["port"][0]), int(get_data["left"][0]), event, int(get_data["uploaded"][0]), 
+                int(get_data["downloaded"][0]), profile and profile.user_id or 0,
+                0 if table is not None else max_peers, compact or no_peer_id)
+    except (IOError, EOFError):
+        return make_error_response("Tracker temporarily unavailable.")
+    if "failure reason" in reply:
+        return make_error_response(reply["failure reason"])
+
+    # Registered users get the transferred data and seeding/leeching changes added to their profile.
+    if profile is not None:
+        update_profile(profile, reply["uploaded"], reply["downloaded"], reply["was"], reply["state"])
+    remove_expired_from_user_counts(reply["expired"])
+
+    # Only touch the torrent row when the counters changed.
+    if event == "completed":
+        Torrent.objects.filter(id = torrent.id).update(downloads = F('downloads') + 1)
+    if torrent.seeders != reply["complete"] or torrent.leechers != reply["incomplete"]:
+        Torrent.objects.filter(id = torrent.id).update(seeders = reply["complete"], leechers = reply["incomplete"])
+
+    peer_data = reply["peers"]
+    if table is not None:
+        peer_data = table.get_random_peers(max_peers)
+        if peer_data is None:
+            # No consistent read, the table is dropped and the peers are asked from the shard instead.
+            del _peer_tables[info_hash]
+            table.close()
+            try:
+                peer_data = get_shard_client().peers(info_hash, max_peers, True)
+            except (IOError, EOFError):
+                peer_data = ""
+
+    if compact: # Compact response, already packed by the shard or peer table.
+        peers = peer_data
+    elif no_peer_id: # No peer_id in response, records of ip (4 bytes) and port (2 bytes).
+        records = [peer_data[i:i+6] for i in range(0, len(peer_data), 6)]
+        peers = [{"ip": inet_ntoa(r[:4]), "port": struct.unpack('!H', r[4:])[0]} for r in records]
+    else: # Records of peer_id (20 bytes), ip (4 bytes) and port (2 bytes).
+        records = [peer_data[i:i+26] for i in range(0, len(peer_data), 26)]
+        peers = [{"peer id": r[:20], "ip": inet_ntoa(r[20:24]), "port": struct.unpack('!H', r[24:])[0]} for r in records]
+
+    response = bencode.bencode_announce(torrent_interval, reply["complete"], reply["incomplete"], peers)
+    return HttpResponse(response, mimetype="text/plain")
+
+def announce(request, torrent_pass=None):
+    """ 
+    The announcer for the tracker.
+    Requests to this is sent from torrent clients.
+    """
+
+    import cgi
+
+    def get_indata_error(data):
+        error = None
+        if not "info_hash" in get_data:
+            error = "no info hash"
+        elif not "peer_id" in get_data:
+            error = "no peer id"
+        elif not "port" in get_data:
+            error = "no port"
+        elif not "uploaded" in get_data:
+            error = "no uploaded"
+        elif not "downloaded" in get_data:
+            error = "no downloaded"
+        elif not "left" in get_data:
+            error = "no left"
+        else:
+            error = get_indata_value_error(get_data)
+        return error
+
+    # Make sure that the torrent client sent a query string.
+    if request.META['QUERY_STRING']:
+        get_data = cgi.parse_qs(request.META['QUERY_STRING'])
+    else:
+        return make_error_response("No query string")
+
+    # Validate the torrents indata.
+    error = get_indata_error(get_data)
+    if error:
+        return make_error_response(error)
+
+    # Get users IP address.
+    ip = request.META['REMOTE_ADDR'] 
+
+    # Get the info hash of the torrent.
+    info_hash = get_data["info_hash"][0].encode("hex")
+
+    # Check if torrent exists.
+    try:
+        torrent = Torrent.objects.get(info_hash=info_hash)
+    except Torrent.DoesNotExist:
+        return make_error_response("No such torrent.")
+
+    # In sharded mode the swarm is kept by a shard process instead of the database.
+    if getattr(settings, 'SWARM_SHARDS', DEFAULT_SWARM_SHARDS):
+        return announce_to_shard(torrent, get_data, ip, torrent_pass)
+
+    # Check if a peer exists, otherwise create a new one.
+    peer_id = get_data["peer_id"][0].encode("hex")
+    peer, created = torrent.peers.get_or_create(peer_id = peer_id, defaults = {'ip' : ip, 'port' : int(get_data["port"][0])})
+
+    # State of the peer before this announce, for the users seeding/leeching counters.
+    if created or peer.user_id is None:
+        was = ABSENT
+    else:
+        was = peer.seeding and SEEDER or LEECHER
+
+    # True if the peer should be added to the peer list.
+    add_peer = True 
+
+    # Make peer into a seeder if he has all data.
+    if int(get_data["left"][0]) == 0:
+        peer.seeding = True
+        peer.save()
+
+    # Check if not just a regular call
+    if "event" in get_data:
+        event = get_data["event"][0]
+        if event == "started":
+            # reset uploaded / downloaded
+            peer.downloaded = 0
+            peer.uploaded = 0
+            peer.save()
+        elif event == "completed":
+            torrent.downloads += 1
+            torrent.save()
+        elif event == "stopped":
+            peer.delete()
+            add_peer = False
+
+    # Check if it is a registered user. Registered users are nice.
+    if torrent_pass:
+        try:
+            profile = UserProfile.objects.get(torrent_pass = torrent_pass)
+            update_profile(profile, int(get_data["uploaded"][0]) - peer.uploaded,
+                    int(get_data["downloaded"][0]) - peer.downloaded, was,
+                    add_peer and (peer.seeding and SEEDER or LEECHER) or ABSENT)
+
+            # A stopped peer is already deleted, saving it again would recreate it.
+            if add_peer:
+                peer.uploaded = get_data["uploaded"][0]
+                peer.downloaded = get_data["downloaded"][0]
+                peer.user = profile.user # Bind user to peer.
+                peer.save()
+        except UserProfile.DoesNotExist:
+            pass # Not a registered used, keep going.
+
+    # Remove peers that haven't been seen in TORRENT_INTERVAL*2 minutes.
+    torrent_interval = getattr(settings, 'TORRENT_INTERVAL', DEFAULT_TORRENT_INTERVAL)
+    expired = torrent.peers.filter(seen__lt = datetime.datetime.now()-datetime.timedelta(seconds=torrent_interval*2))
+    remove_expired_from_user_counts(expired.filter(user__isnull = False).values_list('user', 'seeding'))
+    expired.delete()
+
+    # Add peer to peer list as long as he hasn't stopped.
+    if add_peer:
+        torrent.peers.add(peer)
+
+    # Update values for leechers and seeders.
+    torrent.leechers = torrent.peers.filter(seeding = False).count()
+    torrent.seeders = torrent.peers.filter(seeding = True).count()
+    torrent.save()
+
+    # Check if the client wants a specific number of peers, otherwise default to TORRENT_MAX_REPLY_PEERS.
+    max_peers = get_max_peers(get_data)
+
+    # Get a set of peers (randomized order) to return. Not using order_by='?' since it doesn't work with MySQL for
+    # large data sets,
+    peer_set = get_random_peers(torrent.peers, max_peers)
+
+    if "compact" in get_data and get_data["compact"][0]: # Compact response.
+        peers = "".join([inet_aton(str(p.ip)) + chr(p.port>>8) + chr(p.port&255) for p in peer_set]) 
+    else: # Normal response.
+        if "no_peer_id" in get_data and get_data["no_peer_id"][0]: # No peer_id in response.
+            peers = [{"ip": str(p.ip), "port": int(p.port)} for p in peer_set]
+        else: # Response with peer_id.
+            peers = [{"peer id": str(p.peer_id), "ip": str(p.ip), "port": int(p.port)} for p in peer_set]
+
+    # Bencode and send the response. 
+    response = bencode.bencode_announce(torrent_interval, torrent.seeders, torrent.leechers, peers)
+    return HttpResponse(response, mimetype="text/plain")
+
@@ -14,6 +14,8 @@
 # Modifications:
 # Jan 3, 2010:
 # get_hash added by Bjorn Kempen (bjorn.kempen@gmail.com).
+# Oct 19, 2026:
+# bencode_announce and bencode_failure added, fast paths for tracker responses.
 #
 # --------------------------------------------------------------- 
 
@@ -137,6 +139,40 @@ def bencode(x):
     encode_func[type(x)](x, r)
     return ''.join(r)
 
+# Announce responses always have the same keys, so their encodings are precomputed (in sorted order)
+# and the values are formatted into a single string.
+ANNOUNCE_FORMAT = 'd8:completei%de10:incompletei%de8:intervali%de5:peers'
+COMPACT_ANNOUNCE_FORMAT = ANNOUNCE_FORMAT + '%d:%se'
+PEER_FORMAT = 'd2:ip%d:%s4:porti%dee'
+PEER_WITH_ID_FORMAT = 'd2:ip%d:%s7:peer id%d:%s4:porti%dee'
+FAILURE_FORMAT = 'd14:failure reason%d:%se'
+
+def bencode_announce(interval, complete, incomplete, peers):
+    """
+    Same as bencode({"interval": interval, "complete": complete, "incomplete": incomplete, "peers": peers}).
+    peers is either a compact peer string or a list of {"ip", "port"} or {"ip", "peer id", "port"} dicts.
+    """
+
+    if type(peers) is StringType:
+        return COMPACT_ANNOUNCE_FORMAT % (complete, incomplete, interval, len(peers), peers)
+    r = [ANNOUNCE_FORMAT % (complete, incomplete, interval), 'l']
+    for p in peers:
+        ip = p["ip"]
+        if "peer id" in p:
+            peer_id = p["peer id"]
+            r.append(PEER_WITH_ID_FORMAT % (len(ip), ip, len(peer_id), peer_id, p["port"]))
+        else:
+            r.append(PEER_FORMAT % (len(ip), ip, p["port"]))
+    r.append('ee')
+    return ''.join(r)
+
+def bencode_failure(reason):
+    """
+    Same as bencode({"failure reason": reason}).
+    """
+
+    return FAILURE_FORMAT % (len(reason), reason)
+
 def get_hash(data):
     import hashlib
     metainfo = bdecode(data)
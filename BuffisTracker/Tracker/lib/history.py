@@ -0,0 +1,149 @@
+"""
+Per torrent swarm history.
+
+Every minute a shard samples the seeders, leechers and downloads of its swarms into a History (when
+swarms are kept in the database, the runhistory command samples the torrent rows instead). Each
+History keeps three series of decreasing resolution (minutes, hours and days). A series is stored
+column by column in arrays of 32 bit values, and the oldest values are dropped once it is full. When
+a sample starts a new hour (or day), the previous hour (or day) is rolled up from the finer series:
+seeders and leechers are averaged and downloads, a running total, is the last value seen.
+
+Torrents without peers get no history, and a history is dropped once its torrent has had no peers
+for DROP_AFTER seconds.
+"""
+
+from array import array
+from collections import namedtuple
+
+# (name, seconds per value, number of values kept)
+RESOLUTIONS = (
+    ('minute', 60, 120),
+    ('hour', 60*60, 24*7),
+    ('day', 24*60*60, 365),
+)
+
+DROP_AFTER = 24*60*60
+
+# The values sampled from a torrent, when it isn't sampled from a Swarm.
+Counters = namedtuple('Counters', 'seeders leechers downloads')
+
+class Series(object):
+
+    __slots__ = ['times', 'seeders', 'leechers', 'downloads', 'size']
+
+    def __init__(self, size):
+        self.times = array('I')
+        self.seeders = array('I')
+        self.leechers = array('I')
+        self.downloads = array('I')
+        self.size = size
+
+    def columns(self):
+        return (self.times, self.seeders, self.leechers, self.downloads)
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, time, seeders, leechers, downloads):
+        for column, value in zip(self.columns(), (time, seeders, leechers, downloads)):
+            column.append(value)
+            if len(column) > self.size:
+                del column[0]
+
+    def rollup(self, start, end):
+        """
+        Returns (seeders, leechers, downloads) summarising the values in [start, end), or None if
+        there are none.
+        """
+
+        indexes = [i for i in xrange(len(self.times)) if start <= self.times[i] < end]
+        if not indexes:
+            return None
+        return (sum([self.seeders[i] for i in indexes]) // len(indexes),
+                sum([self.leechers[i] for i in indexes]) // len(indexes),
+                self.downloads[indexes[-1]])
+
+    def as_dict(self):
+        return {'times': self.times.tolist(), 'seeders': self.seeders.tolist(),
+                'leechers': self.leechers.tolist(), 'downloads': self.downloads.tolist()}
+
+class History(object):
+    """
+    The history of one torrent, at every resolution in RESOLUTIONS.
+    """
+
+    __slots__ = ['series', 'rolled_up', 'last_active']
+
+    def __init__(self):
+        self.series = [Series(size) for name, period, size in RESOLUTIONS]
+        self.rolled_up = [0] * len(RESOLUTIONS) # Start of the last period rolled up, per resolution.
+        self.last_active = 0 # Last sample with any peers.
+
+    def sample(self, now, seeders, leechers, downloads):
+        self.series[0].append(now - now % RESOLUTIONS[0][1], seeders, leechers, downloads)
+
+        for i in range(1, len(RESOLUTIONS)):
+            period = RESOLUTIONS[i][1]
+            previous_start = now - now % period - period
+
+            # Roll up the previous period once, on the first sample after it ended.
+            if self.rolled_up[i] < previous_start:
+                self.rolled_up[i] = previous_start
+                values = self.series[i-1].rollup(previous_start, previous_start + period)
+                if values is not None:
+                    self.series[i].append(previous_start, *values)
+
+    def as_dict(self):
+        result = {}
+        for (name, period, size), series in zip(RESOLUTIONS, self.series):
+            result[name] = series.as_dict()
+        return result
+
+class HistoryTable(object):
+    """
+    The histories of all swarms held by one process, keyed by raw info_hash.
+    """
+
+    def __init__(self):
+        self.histories = {}
+
+    def __len__(self):
+        return len(self.histories)
+
+    def __iter__(self):
+        return self.histories.iteritems()
+
+    def sample(self, info_hashes, counters, now):
+        """
+        Samples the torrents in info_hashes from counters, a dict of info_hash -> object with
+        seeders, leechers and downloads (a Swarm or Counters). Returns the info_hashes of torrents
+        that have had no peers for DROP_AFTER seconds, or never had any while sampled.
+        """
+
+        histories = self.histories
+        inactive = []
+        for info_hash in info_hashes:
+            values = counters.get(info_hash)
+            if values is None:
+                continue
+            history = histories.get(info_hash)
+            if values.seeders or values.leechers:
+                if history is None:
+                    history = histories[info_hash] = History()
+                history.last_active = now
+            elif history is None or now - history.last_active > DROP_AFTER:
+                histories.pop(info_hash, None)
+                inactive.append(info_hash)
+                continue
+            history.sample(now, values.seeders, values.leechers, values.downloads)
+        return inactive
+
+    def get(self, info_hash):
+        """
+        Returns the history of a torrent as a dict of series, or None if it has not been sampled.
+        """
+
+        history = self.histories.get(info_hash)
+        if history is None:
+            return None
+        return history.as_dict()
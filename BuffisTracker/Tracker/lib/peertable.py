@@ -0,0 +1,191 @@
+"""
+Shared memory peer tables.
+
+A peer table is an mmap backed file holding fixed size peer records for one torrent, so that every
+web worker can read peers without asking the shard or the database. Each table has a single writer
+(the shard owning the torrent) and any number of lock-free readers.
+
+Layout (network byte order):
+    header: magic (4s), generation (I), count (I), capacity (I)
+    record: ip (4s), port (H), flags (B), padding (x), last seen (I)
+
+The first 6 bytes of a record are the compact peer encoding, so compact replies are built by
+slicing the mapped records directly.
+
+Python 2 keeps a duplicate of the file descriptor for as long as a table is mapped, so the shards
+and workers only keep a bounded number of tables open. A writer closing a table changes its magic
+to CLOSED_MAGIC, readers then stop using it until a writer opens it again.
+
+The writer makes the generation odd while it changes the table and even again when done. A reader
+retries if it saw an odd generation, or if the generation changed while it was reading. It gives up
+after MAX_READ_RETRIES, so a writer that died halfway through a change can't make readers spin.
+"""
+
+import mmap
+import os
+import random
+import struct
+
+MAGIC = 'BTPT'
+CLOSED_MAGIC = 'BTPX'
+HEADER = struct.Struct('!4sIII')
+RECORD = struct.Struct('!4sHBxI')
+GENERATION_OFFSET = 4
+COUNT_END = 12
+
+FLAG_SEEDING = 1
+
+DEFAULT_CAPACITY = 1000
+
+MAX_READ_RETRIES = 100
+
+def peer_table_path(table_dir, info_hash):
+    return os.path.join(table_dir, '%s.peers' % info_hash.encode('hex'))
+
+def _record_offset(slot):
+    return HEADER.size + slot * RECORD.size
+
+class PeerTableWriter(object):
+    """
+    Writer side of a peer table. Keeps up to capacity peers of a swarm in the table, the rest are
+    held back and moved in as slots are freed.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            # Reuse the capacity and generation of an existing table, readers may still map it.
+            generation = 0
+            header = os.read(fd, HEADER.size)
+            if len(header) == HEADER.size:
+                magic, generation, count, old_capacity = HEADER.unpack(header)
+                if magic in (MAGIC, CLOSED_MAGIC):
+                    capacity = max(capacity, old_capacity)
+                    generation += generation & 1
+                else:
+                    generation = 0
+            os.ftruncate(fd, _record_offset(capacity))
+            self.map = mmap.mmap(fd, _record_offset(capacity))
+        finally:
+            os.close(fd)
+
+        self.capacity = capacity
+        self.generation = generation
+        self.slots = {} # peer_id -> slot
+        self.peer_ids = [] # slot -> peer_id
+        self.overflow = set()
+        self._begin()
+        self.map[:HEADER.size] = HEADER.pack(MAGIC, self.generation, 0, self.capacity)
+        self._end()
+
+    def _begin(self):
+        self.generation += 1
+        self.map[GENERATION_OFFSET:GENERATION_OFFSET+4] = struct.pack('!I', self.generation)
+
+    def _end(self):
+        self.generation += 1
+        self.map[GENERATION_OFFSET:COUNT_END] = struct.pack('!II', self.generation, len(self.peer_ids))
+
+    def _write(self, slot, ip, port, seeding, seen):
+        offset = _record_offset(slot)
+        self.map[offset:offset+RECORD.size] = RECORD.pack(ip, port, seeding and FLAG_SEEDING or 0, seen)
+
+    def update(self, peer_id, ip, port, seeding, seen):
+        """
+        Adds or updates a peer.
+        """
+
+        slot = self.slots.get(peer_id)
+        if slot is None:
+            if len(self.peer_ids) >= self.capacity:
+                self.overflow.add(peer_id)
+                return
+            slot = self.slots[peer_id] = len(self.peer_ids)
+            self.peer_ids.append(peer_id)
+        self._begin()
+        self._write(slot, ip, port, seeding, seen)
+        self._end()
+
+    def remove(self, peer_id, peers):
+        """
+        Removes a peer. The freed slot is filled by the last record, or by a held back peer from
+        peers, the swarm's peer_id -> (ip, port, seeding, seen, ...) mapping.
+        """
+
+        if peer_id in self.overflow:
+            self.overflow.remove(peer_id)
+            return
+        slot = self.slots.pop(peer_id, None)
+        if slot is None:
+            return
+
+        self._begin()
+        last_id = self.peer_ids.pop()
+        if last_id != peer_id:
+            last_offset = _record_offset(len(self.peer_ids))
+            offset = _record_offset(slot)
+            self.map[offset:offset+RECORD.size] = self.map[last_offset:last_offset+RECORD.size]
+            self.peer_ids[slot] = last_id
+            self.slots[last_id] = slot
+        if self.overflow:
+            new_id = self.overflow.pop()
+            self.slots[new_id] = len(self.peer_ids)
+            self.peer_ids.append(new_id)
+            self._write(self.slots[new_id], *peers[new_id][:4])
+        self._end()
+
+    def close(self):
+        """
+        Marks the table as closed for the readers and unmaps it.
+        """
+
+        self._begin()
+        self.map[:len(CLOSED_MAGIC)] = CLOSED_MAGIC
+        self._end()
+        self.map.close()
+
+class PeerTableReader(object):
+    """
+    Reader side of a peer table. Never blocks the writer, reads are retried instead.
+    """
+
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            magic, generation, count, capacity = HEADER.unpack(os.read(fd, HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("not a peer table: %s" % path)
+            self.map = mmap.mmap(fd, _record_offset(capacity), access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self.capacity = capacity
+
+    def _read_header(self):
+        return struct.unpack('!4sII', self.map[:COUNT_END])
+
+    def _read_consistent(self, read):
+        for i in xrange(MAX_READ_RETRIES):
+            magic, generation, count = self._read_header()
+            if magic != MAGIC:
+                return None
+            if generation & 1:
+                continue
+            result = read(min(count, self.capacity))
+            if self._read_header()[1] == generation:
+                return result
+        return None
+
+    def get_random_peers(self, num_random):
+        """
+        Returns the compact encoding (6 bytes per peer) of up to num_random random peers, or None
+        if the table was closed or no consistent read was possible.
+        """
+
+        def read(count):
+            m = self.map
+            offsets = [_record_offset(slot) for slot in random.sample(xrange(count), min(num_random, count))]
+            return "".join([m[offset:offset+6] for offset in offsets])
+        return self._read_consistent(read)
+
+    def close(self):
+        self.map.close()
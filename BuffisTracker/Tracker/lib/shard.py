@@ -0,0 +1,479 @@
+"""
+Swarm sharding across processes.
+
+Under a preforking server every worker process would otherwise keep its own idea of the swarms.
+In sharded mode the info_hashes are partitioned over a number of shard processes, each owning the
+in-memory swarms (see swarm.py) for its part of the hash space. Any front-end worker can forward an
+announce to the owning shard over a Unix socket.
+
+Messages in both directions are bencoded dicts, prefixed by their length as a 4 byte unsigned int.
+A connection carries a single request and its reply. Every shard is single threaded, so it is the
+only writer of its swarms and needs no locking. If given a table_dir, a shard also mirrors its
+swarms into shared memory peer tables (see peertable.py) that the workers read peers from.
+If given a snapshot_path, a shard periodically saves its swarms there (see snapshot.py) from a
+forked child, so it keeps answering while the snapshot is written, and loads them again when started. Every shard also samples the history of its swarms each minute
+(see history.py), a slice at a time between requests, and drops swarms that stayed empty.
+"""
+
+import logging
+import os
+import signal
+import socket
+import sys
+import struct
+import time
+import SocketServer
+from collections import OrderedDict
+import BuffisTracker.Tracker.lib.bencode as bencode
+from BuffisTracker.Tracker.lib.swarm import SwarmTable, IP, PORT, SEEDING, USER
+from BuffisTracker.Tracker.lib.peertable import PeerTableWriter, peer_table_path
+from BuffisTracker.Tracker.lib.snapshot import save_snapshot, load_snapshot, SnapshotError
+from BuffisTracker.Tracker.lib.history import HistoryTable
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# How often (in seconds) a swarm is checked for peers that stopped announcing.
+EXPIRE_EVERY = 60
+
+# How often (in seconds) the swarm history is sampled.
+SAMPLE_EVERY = 60
+
+# Sampling is done in batches of SAMPLE_BATCH swarms, for at most SAMPLE_SLICE seconds between two
+# requests, so a shard with many swarms doesn't stop answering while it samples them all.
+SAMPLE_BATCH = 100
+SAMPLE_SLICE = 0.005
+
+# Seconds a worker waits for a shard to answer before giving up on the request.
+DEFAULT_TIMEOUT = 5
+
+# Peer tables a shard or worker process keeps open, each one holds a file descriptor.
+DEFAULT_MAX_TABLES = 256
+
+# Limits of the announce fields, so a bad value can't break the packing of peers or snapshots.
+# Transfer counters are kept as signed 64 bit integers. Also checked by the workers (see announce.py).
+MAX_PORT = 65535
+MAX_BYTES = 2**63 - 1
+MAX_USER = 2**32 - 1
+
+def shard_for(info_hash, num_shards):
+    """
+    Returns the index of the shard owning a raw info_hash. The hashes are SHA1 digests, so the
+    first four bytes are uniform enough to spread the torrents evenly.
+    """
+
+    return struct.unpack('!I', info_hash[:4])[0] % num_shards
+
+def get_shard_paths(directory, num_shards, extension='sock'):
+    return [os.path.join(directory, 'shard-%d.%s' % (i, extension)) for i in range(num_shards)]
+
+def get_history_path(directory, extension='sock'):
+    """
+    Path of the history server, which samples the torrents when swarms are kept in the database.
+    """
+
+    return os.path.join(directory, 'history.%s' % extension)
+
+def get_announce_error(message):
+    """
+    Returns an error message if an announce message is malformed or out of range, otherwise None.
+    """
+
+    def is_int(value, low, high):
+        return isinstance(value, (int, long)) and low <= value <= high
+
+    for key, length in (('info_hash', 20), ('peer_id', 20), ('ip', 4)):
+        if not isinstance(message.get(key), str) or len(message[key]) != length:
+            return 'invalid %s' % key
+    if not is_int(message.get('port'), 0, MAX_PORT):
+        return 'invalid port'
+    for key in ('uploaded', 'downloaded', 'left'):
+        if not is_int(message.get(key), 0, MAX_BYTES):
+            return 'invalid %s' % key
+    if not is_int(message.get('user'), 0, MAX_USER):
+        return 'invalid user'
+    if not is_int(message.get('numwant'), 0, sys.maxint) or not isinstance(message.get('event'), str):
+        return 'invalid announce'
+    return None
+
+def _recv_exactly(sock, num_bytes):
+    chunks = []
+    while num_bytes:
+        chunk = sock.recv(num_bytes)
+        if not chunk:
+            raise EOFError("connection closed by shard")
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return ''.join(chunks)
+
+def send_message(sock, message):
+    data = bencode.bencode(message)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+def recv_message(sock):
+    length, = struct.unpack('!I', _recv_exactly(sock, 4))
+    return bencode.bdecode(_recv_exactly(sock, length))
+
+class ShardRequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        self.request.settimeout(self.server.request_timeout)
+        send_message(self.request, self.server.dispatch(recv_message(self.request)))
+
+class ShardServer(SocketServer.UnixStreamServer):
+    """
+    A single shard. Owns a SwarmTable and answers requests forwarded by the front-end workers.
+    """
+
+    # Seconds handle_request waits for a connection before giving periodic work a chance to run.
+    timeout = 1
+
+    # Seconds a connection may take to send its request or read the reply, so a stuck worker can't
+    # stall the shard for all the others.
+    request_timeout = 2
+
+    def __init__(self, path, torrent_interval, table_dir=None, snapshot_path=None, snapshot_interval=60,
+            max_tables=DEFAULT_MAX_TABLES, num_shards=1):
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, ShardRequestHandler)
+        self.path = path
+        self.torrent_interval = torrent_interval
+        self.table_dir = table_dir
+        self.max_tables = max_tables
+        self.open_tables = OrderedDict() # info_hash -> swarm, least recently announced first.
+        self.swarms = SwarmTable()
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.num_shards = num_shards
+        self.next_snapshot = time.time() + snapshot_interval
+        self.snapshot_pid = None # Child process writing a snapshot, if any.
+        self.history = HistoryTable()
+        self.next_sample = 0
+        self.sample_keys = [] # info_hashes left to sample in this round.
+        self.sample_counters = {}
+        self.sample_time = 0
+        self.expired = [] # [user, seeding] of expired peers, until reported in an announce reply.
+        self.stopping = False
+
+        # Warm restart, peers that would have expired by now are left out.
+        if snapshot_path and os.path.exists(snapshot_path):
+            try:
+                load_snapshot(self.swarms, snapshot_path, int(time.time()) - torrent_interval * 2, num_shards,
+                        self.history)
+            except (SnapshotError, EnvironmentError), e:
+                log.warning("starting without snapshot: %s", e)
+                self.swarms = SwarmTable()
+                self.history = HistoryTable()
+
+    def handle_error(self, request, client_address):
+        # Logged rather than printed. A worker that went away or timed out is not worth a traceback.
+        error = sys.exc_info()[1]
+        if isinstance(error, (socket.error, EOFError)):
+            log.warning("request dropped: %s", error)
+        else:
+            log.exception("request failed")
+
+    def dispatch(self, message):
+        if not isinstance(message, dict):
+            return {'failure reason': 'invalid message'}
+        handler = getattr(self, 'op_%s' % message.get('op'), None)
+        if handler is None:
+            return {'failure reason': 'unknown op'}
+        return handler(message)
+
+    def _pack_peers(self, swarm, numwant, compact):
+        # Compact replies are 6 byte records (ip, port), others are prefixed by the 20 byte peer_id.
+        peer_set = swarm.get_random_peers(numwant)
+        if compact:
+            return "".join([p[IP] + struct.pack('!H', p[PORT]) for peer_id, p in peer_set])
+        return "".join([peer_id + p[IP] + struct.pack('!H', p[PORT]) for peer_id, p in peer_set])
+
+    def _open_table(self, info_hash, swarm):
+        """
+        Mirrors a swarm into its peer table. Only max_tables are kept open, the table of the swarm
+        announced to least recently is closed to make room.
+        """
+
+        open_tables = self.open_tables
+        if swarm.table is not None:
+            del open_tables[info_hash]
+            open_tables[info_hash] = swarm
+            return
+        try:
+            swarm.table = PeerTableWriter(peer_table_path(self.table_dir, info_hash))
+        except EnvironmentError:
+            return # The workers ask the shard for peers until the table can be opened.
+        for peer_id, peer in swarm.peers.iteritems():
+            swarm.table.update(peer_id, *peer[:4])
+        open_tables[info_hash] = swarm
+        while len(open_tables) > self.max_tables:
+            old_hash, old_swarm = open_tables.popitem(last=False)
+            old_swarm.table.close()
+            old_swarm.table = None
+
+    def op_history(self, message):
+        return {'history': self.history.get(message['info_hash']) or {}}
+
+    def op_user_counts(self, message):
+        """
+        Returns [user, seeding, leeching] for every user with peers in this shard.
+        """
+
+        counts = {}
+        for info_hash, swarm in self.swarms:
+            for peer in swarm.peers.itervalues():
+                if peer[USER]:
+                    user_counts = counts.get(peer[USER]) or counts.setdefault(peer[USER], [0, 0])
+                    user_counts[not peer[SEEDING]] += 1
+        return {'counts': [[user, seeding, leeching] for user, (seeding, leeching) in counts.iteritems()]}
+
+    def expire_peers(self, swarm, now):
+        """
+        Removes peers that haven't been seen in TORRENT_INTERVAL*2. The users of removed peers are
+        reported back in the next announce reply, so their seeding/leeching counters can be decreased.
+        """
+
+        self.expired.extend([[p[USER], int(p[SEEDING])] for p in swarm.expire(now - self.torrent_interval * 2)
+                if p[USER]])
+        swarm.next_expire = now + EXPIRE_EVERY
+
+    def op_announce(self, message):
+        error = get_announce_error(message)
+        if error:
+            return {'failure reason': error}
+
+        now = int(time.time())
+        swarm = self.swarms.get(message['info_hash'])
+        if self.table_dir:
+            self._open_table(message['info_hash'], swarm)
+
+        if now >= swarm.next_expire:
+            self.expire_peers(swarm, now)
+        expired, self.expired = self.expired, []
+
+        uploaded, downloaded, was, state = swarm.announce(message['peer_id'], message['ip'], message['port'],
+                message['left'], message['event'], message['uploaded'], message['downloaded'], message['user'], now)
+
+        return {'complete': swarm.seeders, 'incomplete': swarm.leechers, 'downloads': swarm.downloads,
+                'uploaded': uploaded, 'downloaded': downloaded, 'was': was, 'state': state,
+                'expired': expired, 'peers': self._pack_peers(swarm, message['numwant'], message['compact'])}
+
+    def op_peers(self, message):
+        """
+        Returns peers without announcing, for workers that couldn't read them from a peer table.
+        """
+
+        swarm = self.swarms.swarms.get(message['info_hash'])
+        if swarm is None:
+            return {'peers': ''}
+        return {'peers': self._pack_peers(swarm, message['numwant'], message['compact'])}
+
+    def save_snapshot(self):
+        """
+        Saves the swarms if snapshots are used, after waiting for a snapshot being written in the
+        background. A failed save is logged and left for the next one, the shard keeps serving.
+        Returns False if the save failed.
+        """
+
+        self.reap_snapshot(0)
+        if self.snapshot_path:
+            try:
+                save_snapshot(self.swarms, self.snapshot_path, int(time.time()), self.num_shards, self.history)
+            except (EnvironmentError, struct.error), e:
+                log.error("saving snapshot %s failed: %s", self.snapshot_path, e)
+                return False
+        return True
+
+    def fork_snapshot(self):
+        """
+        Saves the swarms in a child process, which writes its copy-on-write copy of them while the
+        shard goes on serving. Saved in the shard itself if forking fails.
+        """
+
+        try:
+            pid = os.fork()
+        except OSError, e:
+            log.error("forking to save snapshot failed: %s", e)
+            self.save_snapshot()
+            return
+        if pid == 0:
+            # The child leaves with os._exit, so it doesn't run any cleanup of the shard's socket,
+            # peer tables or database connection.
+            status = 1
+            try:
+                status = not self.save_snapshot()
+            finally:
+                os._exit(status)
+        self.snapshot_pid = pid
+
+    def reap_snapshot(self, options=os.WNOHANG):
+        """
+        Reaps the child writing a snapshot if it has finished, or waits for it unless options is
+        os.WNOHANG. The child logs failed saves itself.
+        """
+
+        if self.snapshot_pid is None:
+            return
+        pid, status = os.waitpid(self.snapshot_pid, options)
+        if pid:
+            self.snapshot_pid = None
+            if os.WIFSIGNALED(status):
+                log.error("snapshot process killed by signal %d", os.WTERMSIG(status))
+
+    def get_counters(self):
+        """
+        Returns the info_hash -> counters dict the history is sampled from.
+        """
+
+        return self.swarms.swarms
+
+    def drop_swarm(self, info_hash):
+        """
+        Drops a swarm that has had no peers for a while, along with its peer table. The table is
+        closed first, so workers that still have it mapped stop reading it, then its file is removed.
+        """
+
+        swarm = self.swarms.swarms.get(info_hash)
+        if swarm is None or swarm.peers:
+            return
+        del self.swarms.swarms[info_hash]
+        if swarm.table is not None:
+            del self.open_tables[info_hash]
+            swarm.table.close()
+            swarm.table = None
+        if self.table_dir:
+            try:
+                os.unlink(peer_table_path(self.table_dir, info_hash))
+            except OSError:
+                pass # Never created, or the table of a swarm closed to make room is already gone.
+
+    def sample_slice(self):
+        """
+        Samples the next batches of the current round, for at most SAMPLE_SLICE seconds. Swarms are
+        expired before they are sampled, so a torrent nobody announces to any more loses its peers
+        and is dropped in the end.
+        """
+
+        keys = self.sample_keys
+        swarms = self.swarms.swarms
+        deadline = time.time() + SAMPLE_SLICE
+        while keys and time.time() < deadline:
+            batch = keys[-SAMPLE_BATCH:]
+            del keys[-SAMPLE_BATCH:]
+            for info_hash in batch:
+                swarm = swarms.get(info_hash)
+                if swarm is not None and self.sample_time >= swarm.next_expire:
+                    self.expire_peers(swarm, self.sample_time)
+            for info_hash in self.history.sample(batch, self.sample_counters, self.sample_time):
+                self.drop_swarm(info_hash)
+
+    def run_periodic(self, now):
+        """
+        Samples the swarm history and starts saving a snapshot when they are due. A round of samples that
+        didn't finish before the next one starts is cut short.
+        """
+
+        if now >= self.next_sample:
+            self.sample_counters = self.get_counters()
+            self.sample_keys = self.sample_counters.keys()
+            self.sample_time = int(now)
+            self.next_sample = now - now % SAMPLE_EVERY + SAMPLE_EVERY
+        if self.sample_keys:
+            self.sample_slice()
+        self.reap_snapshot()
+        if self.snapshot_path and now >= self.next_snapshot and self.snapshot_pid is None:
+            self.fork_snapshot()
+            self.next_snapshot = time.time() + self.snapshot_interval
+
+    def serve(self):
+        """
+        Handles requests until the process is stopped, running periodic work in between.
+        """
+
+        while not self.stopping:
+            self.handle_request()
+            self.run_periodic(time.time())
+
+    def stop(self, signum=None, frame=None):
+        """
+        Makes serve return after the current request. Safe to use as a signal handler, unlike raising
+        SystemExit, which handle_error would swallow if it arrived while a request is handled.
+        """
+
+        self.stopping = True
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        for swarm in self.open_tables.itervalues():
+            swarm.table.close()
+            swarm.table = None
+        self.open_tables.clear()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def run_shard(path, torrent_interval, table_dir=None, snapshot_path=None, snapshot_interval=60,
+        max_tables=DEFAULT_MAX_TABLES, num_shards=1):
+    """
+    Runs a shard until it is terminated. Used as the target of the shard processes.
+    """
+
+    serve_until_stopped(ShardServer(path, torrent_interval, table_dir, snapshot_path, snapshot_interval,
+            max_tables, num_shards))
+
+def serve_until_stopped(server):
+    """
+    Serves until SIGTERM, then saves a final snapshot and closes the server.
+    """
+
+    signal.signal(signal.SIGTERM, server.stop)
+    try:
+        server.serve()
+    finally:
+        server.save_snapshot()
+        server.server_close()
+
+class ShardClient(object):
+    """
+    Used by the front-end workers to talk to the shard owning an info_hash. A shard that doesn't
+    answer within timeout seconds raises socket.timeout, an IOError like any other failed request.
+    """
+
+    def __init__(self, paths, timeout=DEFAULT_TIMEOUT):
+        self.paths = paths
+        self.timeout = timeout
+
+    def request_path(self, path, message):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(path)
+            send_message(sock, message)
+            return recv_message(sock)
+        finally:
+            sock.close()
+
+    def request(self, info_hash, message):
+        return self.request_path(self.paths[shard_for(info_hash, len(self.paths))], message)
+
+    def user_counts(self):
+        """
+        Returns [user, seeding, leeching] entries from every shard. A user with peers in several
+        shards has an entry from each of them.
+        """
+
+        counts = []
+        for path in self.paths:
+            counts.extend(self.request_path(path, {'op': 'user_counts'})['counts'])
+        return counts
+
+    def history(self, info_hash):
+        return self.request(info_hash, {'op': 'history', 'info_hash': info_hash})['history']
+
+    def peers(self, info_hash, numwant, compact):
+        return self.request(info_hash, {'op': 'peers', 'info_hash': info_hash, 'numwant': numwant,
+                'compact': int(bool(compact))})['peers']
+
+    def announce(self, info_hash, peer_id, ip, port, left, event, uploaded, downloaded, user, numwant, compact):
+        return self.request(info_hash, {'op': 'announce', 'info_hash': info_hash, 'peer_id': peer_id,
+                'ip': ip, 'port': port, 'left': left, 'event': event, 'uploaded': uploaded,
+                'downloaded': downloaded, 'user': user, 'numwant': numwant, 'compact': int(bool(compact))})
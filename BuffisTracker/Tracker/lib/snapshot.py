@@ -0,0 +1,158 @@
+"""
+Swarm snapshots, so that a restarted shard doesn't have to wait for every peer to re-announce.
+
+A snapshot is a binary file (network byte order):
+    header: magic (4s), version (H), number of shards (H), time written (I), number of torrents (I)
+    per torrent: info_hash (20s), downloads (I), number of peers (I), followed by its peers
+    per peer: peer_id (20s), ip (4s), port (H), flags (B), padding (x), seen (I),
+              uploaded (q), downloaded (q), user (I)
+    after the torrents: number of histories (I), followed by the histories (see history.py)
+    per history: info_hash (20s), last active (I), then per resolution: last rolled up (I),
+                 number of values (I), followed by the times, seeders, leechers and downloads
+                 columns (I each)
+
+The uploaded/downloaded values are the accounting baselines the next announce is compared to.
+Snapshots are written to a temporary file that is renamed over the old one, so a crash while
+writing never leaves a half written snapshot behind. The number of shards is recorded because it
+decides which torrents a shard owns; a snapshot written with a different number is refused.
+"""
+
+import os
+import struct
+import sys
+from array import array
+from BuffisTracker.Tracker.lib.swarm import SEEDING
+from BuffisTracker.Tracker.lib.history import History
+
+MAGIC = 'BTSS'
+VERSION = 4
+HEADER = struct.Struct('!4sHHII')
+TORRENT = struct.Struct('!20sII')
+PEER = struct.Struct('!20s4sHBxIqqI')
+COUNT = struct.Struct('!I')
+HISTORY = struct.Struct('!20sI')
+SERIES = struct.Struct('!II')
+
+FLAG_SEEDING = 1
+
+class SnapshotError(Exception):
+    pass
+
+def _pack_column(column):
+    column = array('I', column)
+    if sys.byteorder == 'little':
+        column.byteswap()
+    return column.tostring()
+
+def _unpack_column(data, offset, length):
+    column = array('I')
+    column.fromstring(data[offset:offset + length * column.itemsize])
+    if len(column) != length:
+        raise struct.error("truncated column")
+    if sys.byteorder == 'little':
+        column.byteswap()
+    return column
+
+def _pack_history(info_hash, history):
+    chunk = [HISTORY.pack(info_hash, history.last_active)]
+    for rolled_up, series in zip(history.rolled_up, history.series):
+        chunk.append(SERIES.pack(rolled_up, len(series)))
+        chunk.extend([_pack_column(column) for column in series.columns()])
+    return ''.join(chunk)
+
+def _unpack_history(data, offset):
+    """
+    Returns (info_hash, history, offset after it).
+    """
+
+    history = History()
+    info_hash, history.last_active = HISTORY.unpack_from(data, offset)
+    offset += HISTORY.size
+    for i, series in enumerate(history.series):
+        history.rolled_up[i], length = SERIES.unpack_from(data, offset)
+        offset += SERIES.size
+        series.times, series.seeders, series.leechers, series.downloads = \
+                [_unpack_column(data, offset + length * 4 * column, length) for column in range(4)]
+        offset += length * 4 * 4
+    return info_hash, history, offset
+
+def save_snapshot(swarms, path, now, num_shards=1, histories=None):
+    """
+    Writes all swarms of a SwarmTable, and the histories of a HistoryTable if given, to path. On
+    failure the temporary file is removed and the previous snapshot is left as it was.
+    """
+
+    tmp_path = '%s.tmp' % path
+    try:
+        f = open(tmp_path, 'wb')
+        try:
+            f.write(HEADER.pack(MAGIC, VERSION, num_shards, now, len(swarms)))
+            for info_hash, swarm in swarms:
+                chunk = [TORRENT.pack(info_hash, swarm.downloads, len(swarm.peers))]
+                for peer_id, (ip, port, seeding, seen, uploaded, downloaded, user) in swarm.peers.iteritems():
+                    chunk.append(PEER.pack(peer_id, ip, port, seeding and FLAG_SEEDING or 0, seen, uploaded, downloaded, user))
+                f.write(''.join(chunk))
+            f.write(COUNT.pack(histories is not None and len(histories) or 0))
+            for info_hash, history in histories or ():
+                f.write(_pack_history(info_hash, history))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def load_snapshot(swarms, path, cutoff, num_shards=1, histories=None):
+    """
+    Loads a snapshot into a SwarmTable, skipping peers not seen since cutoff, and its histories
+    into a HistoryTable if given. Returns the number of peers loaded.
+    """
+
+    f = open(path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    try:
+        magic, version, written_shards, written, num_torrents = HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise SnapshotError("truncated snapshot: %s" % path)
+    if magic != MAGIC or version != VERSION:
+        raise SnapshotError("not a snapshot, or from another version: %s" % path)
+    if written_shards != num_shards:
+        raise SnapshotError("snapshot written by %d shards, not %d: %s" % (written_shards, num_shards, path))
+
+    # This loop runs once per peer, so the lookups are kept local.
+    unpack_peer, peer_size = PEER.unpack_from, PEER.size
+    offset = HEADER.size
+    num_loaded = 0
+    try:
+        for i in xrange(num_torrents):
+            info_hash, downloads, num_peers = TORRENT.unpack_from(data, offset)
+            offset += TORRENT.size
+            swarm = swarms.get(info_hash)
+            swarm.downloads = downloads
+            peers = swarm.peers
+            end = offset + num_peers * peer_size
+            for peer_offset in xrange(offset, end, peer_size):
+                peer_id, ip, port, flags, seen, uploaded, downloaded, user = unpack_peer(data, peer_offset)
+                if seen >= cutoff:
+                    peers[peer_id] = [ip, port, flags == FLAG_SEEDING, seen, uploaded, downloaded, user]
+            offset = end
+            swarm.seeders = len([peer for peer in peers.itervalues() if peer[SEEDING]])
+            swarm.leechers = len(peers) - swarm.seeders
+            num_loaded += len(peers)
+
+        num_histories, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        if histories is not None:
+            for i in xrange(num_histories):
+                info_hash, history, offset = _unpack_history(data, offset)
+                histories.histories[info_hash] = history
+    except struct.error:
+        raise SnapshotError("truncated snapshot: %s" % path)
+    return num_loaded
@@ -0,0 +1,126 @@
+"""
+In-memory swarm state, used by the sharded tracker mode (see shard.py).
+
+A Swarm holds the peers of a single torrent. Peers are keyed by their raw peer_id and stored as
+lists of [ip, port, seeding, seen, uploaded, downloaded, user], where ip is the packed 4 byte
+address, seen is a unix timestamp and user is the id of the peers user (0 if anonymous).
+
+A swarm can be mirrored into a shared memory peer table (see peertable.py) by setting its table.
+"""
+
+import random
+
+# Indexes into a peer entry.
+IP, PORT, SEEDING, SEEN, UPLOADED, DOWNLOADED, USER = range(7)
+
+# Peer states before and after an announce, used for the per-user seeding/leeching counters.
+ABSENT, LEECHER, SEEDER = range(3)
+
+class Swarm(object):
+
+    __slots__ = ['peers', 'seeders', 'leechers', 'downloads', 'next_expire', 'table']
+
+    def __init__(self):
+        self.peers = {}
+        self.seeders = 0
+        self.leechers = 0
+        self.downloads = 0
+        self.next_expire = 0
+        self.table = None
+
+    def add_peer(self, peer_id, peer):
+        self.peers[peer_id] = peer
+        if peer[SEEDING]:
+            self.seeders += 1
+        else:
+            self.leechers += 1
+
+    def remove_peer(self, peer_id):
+        peer = self.peers.pop(peer_id)
+        if peer[SEEDING]:
+            self.seeders -= 1
+        else:
+            self.leechers -= 1
+        if self.table is not None:
+            self.table.remove(peer_id, self.peers)
+        return peer
+
+    def announce(self, peer_id, ip, port, left, event, uploaded, downloaded, user, now):
+        """
+        Registers an announce from a peer, following the same rules as the database backed announce.
+        Returns (uploaded, downloaded, state before, state after), where uploaded and downloaded are the
+        deltas since the peers last announce, for user accounting.
+        """
+
+        peer = self.peers.get(peer_id)
+        if peer is None:
+            was = ABSENT
+            peer = [ip, port, False, now, 0, 0, user]
+            self.add_peer(peer_id, peer)
+        elif peer[USER] != user:
+            was = ABSENT # Not yet counted for this user.
+        else:
+            was = peer[SEEDING] and SEEDER or LEECHER
+        peer[SEEN] = now
+        peer[USER] = user
+
+        # Make peer into a seeder if he has all data.
+        if left == 0 and not peer[SEEDING]:
+            peer[SEEDING] = True
+            self.leechers -= 1
+            self.seeders += 1
+
+        if event == "started":
+            peer[UPLOADED] = 0
+            peer[DOWNLOADED] = 0
+        elif event == "completed":
+            self.downloads += 1
+
+        deltas = (uploaded - peer[UPLOADED], downloaded - peer[DOWNLOADED])
+        peer[UPLOADED] = uploaded
+        peer[DOWNLOADED] = downloaded
+
+        if event == "stopped":
+            self.remove_peer(peer_id)
+            return deltas + (was, ABSENT)
+        if self.table is not None:
+            self.table.update(peer_id, *peer[:4])
+        return deltas + (was, peer[SEEDING] and SEEDER or LEECHER)
+
+    def expire(self, cutoff):
+        """
+        Removes peers that haven't been seen since cutoff. Returns the removed peers.
+        """
+
+        return [self.remove_peer(peer_id) for peer_id, peer in self.peers.items() if peer[SEEN] < cutoff]
+
+    def get_random_peers(self, num_random):
+        """
+        Returns up to num_random (peer_id, peer) pairs in random order.
+        """
+
+        peers = self.peers.items()
+        if len(peers) > num_random:
+            return random.sample(peers, num_random)
+        random.shuffle(peers)
+        return peers
+
+class SwarmTable(object):
+    """
+    All swarms held by one process, keyed by raw info_hash.
+    """
+
+    def __init__(self):
+        self.swarms = {}
+
+    def get(self, info_hash):
+        swarm = self.swarms.get(info_hash)
+        if swarm is None:
+            swarm = self.swarms[info_hash] = Swarm()
+        return swarm
+
+    def __len__(self):
+        return len(self.swarms)
+
+    def __iter__(self):
+        return self.swarms.iteritems()
@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+import logging
+from BuffisTracker.Tracker.models import Torrent
+from BuffisTracker.Tracker.lib.shard import ShardServer, get_history_path, serve_until_stopped
+from BuffisTracker.Tracker.lib.history import Counters
+from BuffisTracker.Tracker.announce import DEFAULT_SWARM_SHARDS, DEFAULT_SWARM_SOCKET_DIR, DEFAULT_SWARM_SNAPSHOT_DIR, \
+        DEFAULT_SWARM_SNAPSHOT_INTERVAL, DEFAULT_TORRENT_INTERVAL
+
+class DatabaseHistoryServer(ShardServer):
+    """
+    Keeps the torrent history when swarms are kept in the database, sampling the seeders, leechers
+    and downloads counters of the torrent rows. Only answers history requests.
+    """
+
+    op_announce = op_peers = op_user_counts = None
+
+    def get_counters(self):
+        counters = dict([(info_hash.decode('hex'), Counters(seeders, leechers, downloads)) for info_hash, seeders, leechers, downloads
+                in Torrent.objects.values_list('info_hash', 'seeders', 'leechers', 'downloads')])
+
+        # End the transaction, so the next round doesn't read from the same snapshot of the database.
+        transaction.commit_unless_managed()
+        return counters
+
+class Command(NoArgsCommand):
+    help = """Samples the seeders, leechers and downloads of every torrent each minute, when SWARM_SHARDS is not set
+(the shards keep the history otherwise). Answers the history requests of the web workers on a Unix socket
+in SWARM_SOCKET_DIR. If SWARM_SNAPSHOT_DIR is set, the history is saved there every SWARM_SNAPSHOT_INTERVAL
+seconds and when stopped, and loaded again on start."""
+
+    def handle_noargs(self, **options):
+        if getattr(settings, 'SWARM_SHARDS', DEFAULT_SWARM_SHARDS):
+            print "SWARM_SHARDS is set, the shards keep the history."
+            return
+        socket_dir = getattr(settings, 'SWARM_SOCKET_DIR', DEFAULT_SWARM_SOCKET_DIR)
+        snapshot_dir = getattr(settings, 'SWARM_SNAPSHOT_DIR', DEFAULT_SWARM_SNAPSHOT_DIR)
+        snapshot_interval = getattr(settings, 'SWARM_SNAPSHOT_INTERVAL', DEFAULT_SWARM_SNAPSHOT_INTERVAL)
+        torrent_interval = getattr(settings, 'TORRENT_INTERVAL', DEFAULT_TORRENT_INTERVAL)
+        snapshot_path = snapshot_dir and get_history_path(snapshot_dir, 'snapshot') or None
+
+        logging.basicConfig(format="%(asctime)s %(name)s: %(message)s")
+        path = get_history_path(socket_dir)
+        print "Sampling torrent history, listening on %s." % path
+        serve_until_stopped(DatabaseHistoryServer(path, torrent_interval, snapshot_path=snapshot_path,
+                snapshot_interval=snapshot_interval))
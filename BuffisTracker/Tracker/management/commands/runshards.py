@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+from multiprocessing import Process
+import logging
+import os
+import signal
+import sys
+import time
+from BuffisTracker.Tracker.lib.shard import get_shard_paths, run_shard
+from BuffisTracker.Tracker.announce import get_shard_client, resync_user_counts
+from BuffisTracker.Tracker.announce import DEFAULT_SWARM_SHARDS, DEFAULT_SWARM_SOCKET_DIR, DEFAULT_PEER_TABLE_DIR, \
+        DEFAULT_PEER_TABLE_MAX_OPEN, DEFAULT_SWARM_SNAPSHOT_DIR, DEFAULT_SWARM_SNAPSHOT_INTERVAL, DEFAULT_TORRENT_INTERVAL
+
+class Command(NoArgsCommand):
+    help = """Starts one swarm shard process per SWARM_SHARDS, listening on Unix sockets in SWARM_SOCKET_DIR.
+If PEER_TABLE_DIR is set, the shards also write shared memory peer tables there for the workers to read,
+keeping at most PEER_TABLE_MAX_OPEN of them open.
+If SWARM_SNAPSHOT_DIR is set, the shards save their swarms there every SWARM_SNAPSHOT_INTERVAL seconds
+and when stopped, and load them again on start. Snapshots saved with another SWARM_SHARDS are not loaded.
+Shards that die are restarted. Whenever shards are started, the seeding/leeching counters of the users
+are set to the peers the shards hold.
+The web workers must be run with the same settings, so they forward announces to the right shard."""
+
+    def handle_noargs(self, **options):
+        num_shards = getattr(settings, 'SWARM_SHARDS', DEFAULT_SWARM_SHARDS)
+        socket_dir = getattr(settings, 'SWARM_SOCKET_DIR', DEFAULT_SWARM_SOCKET_DIR)
+        table_dir = getattr(settings, 'PEER_TABLE_DIR', DEFAULT_PEER_TABLE_DIR)
+        max_tables = getattr(settings, 'PEER_TABLE_MAX_OPEN', DEFAULT_PEER_TABLE_MAX_OPEN)
+        snapshot_dir = getattr(settings, 'SWARM_SNAPSHOT_DIR', DEFAULT_SWARM_SNAPSHOT_DIR)
+        snapshot_interval = getattr(settings, 'SWARM_SNAPSHOT_INTERVAL', DEFAULT_SWARM_SNAPSHOT_INTERVAL)
+        torrent_interval = getattr(settings, 'TORRENT_INTERVAL', DEFAULT_TORRENT_INTERVAL)
+        if not num_shards:
+            print "SWARM_SHARDS is not set, nothing to run."
+            return
+
+        # The shards log failed snapshots and such to stderr.
+        logging.basicConfig(format="%(asctime)s %(name)s: %(message)s")
+
+        if snapshot_dir:
+            snapshot_paths = get_shard_paths(snapshot_dir, num_shards, 'snapshot')
+        else:
+            snapshot_paths = [None] * num_shards
+
+        shard_args = [(path, torrent_interval, table_dir, snapshot_path, snapshot_interval, max_tables, num_shards)
+                for path, snapshot_path in zip(get_shard_paths(socket_dir, num_shards), snapshot_paths)]
+        processes = [self.start_shard(args) for args in shard_args]
+        print "Running %d shards in %s." % (num_shards, socket_dir)
+        self.resync()
+
+        # Restart shards that died, until stopped by SIGTERM or ^C.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                time.sleep(1)
+                for i, process in enumerate(processes):
+                    if not process.is_alive():
+                        print "Shard %d exited with code %s, restarting." % (i, process.exitcode)
+                        processes[i] = self.start_shard(shard_args[i])
+                        self.resync()
+        except (KeyboardInterrupt, SystemExit):
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
+
+    def start_shard(self, args):
+        # The socket is removed first, so that its reappearance shows that the shard is listening.
+        if os.path.exists(args[0]):
+            os.unlink(args[0])
+        process = Process(target=run_shard, args=args)
+        process.start()
+        return process
+
+    def resync(self, timeout=30):
+        """
+        Waits for all shards to listen and resyncs the user counters to their peers.
+        """
+
+        paths = get_shard_client().paths
+        deadline = time.time() + timeout
+        while not all([os.path.exists(path) for path in paths]):
+            if time.time() > deadline:
+                print "Shards didn't start in time, user counters were not resynced."
+                return
+            time.sleep(0.1)
+        try:
+            resync_user_counts()
+        except (IOError, EOFError), e:
+            print "Resyncing user counters failed: %s" % e
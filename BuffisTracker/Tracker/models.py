@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 
 def _get_readable_size(num_bytes):
@@ -45,13 +47,24 @@ class Tag(models.Model):
 
 class UserProfile(models.Model):
     user = models.ForeignKey(User, unique = True)
-    uploaded = models.IntegerField(default = 0)
+    uploaded = models.IntegerField(default = 0, db_index = True)
     downloaded = models.IntegerField(default = 0)
     torrent_pass = models.CharField(max_length = 32)
 
+    # Denormalised stats, kept up to date on upload, delete and announce.
+    num_torrents = models.IntegerField(default = 0)
+    seeding = models.IntegerField(default = 0)
+    leeching = models.IntegerField(default = 0)
+
     @property
-    def num_torrents(self):
-        return self.user.torrent_set.count()
+    def ratio(self):
+        """
+        Uploaded / downloaded, 0 until something is downloaded.
+        """
+
+        if self.downloaded > 0:
+            return float(self.uploaded) / self.downloaded
+        return 0
 
     @property
     def downloaded_readable(self):
@@ -102,3 +115,14 @@ class Comment(models.Model):
 
     def __unicode__(self):
         return "Comment #%d" % self.id
+
+# Keep UserProfile.num_torrents in step with uploads and deletes (also those made through the admin).
+def _count_uploaded_torrent(sender, instance, created, **kwargs):
+    if created:
+        UserProfile.objects.filter(user = instance.user_id).update(num_torrents = F('num_torrents') + 1)
+
+def _count_deleted_torrent(sender, instance, **kwargs):
+    UserProfile.objects.filter(user = instance.user_id).update(num_torrents = F('num_torrents') - 1)
+
+post_save.connect(_count_uploaded_torrent, sender = Torrent)
+post_delete.connect(_count_deleted_torrent, sender = Torrent)
@@ -0,0 +1,4 @@
+-- Comments are listed per torrent, newest first (see get_comments in views.py).
+-- Only run by syncdb when it creates the table. For an existing database, create the index by running
+-- this file, e.g. "manage.py sqlcustom Tracker | manage.py dbshell".
+CREATE INDEX Tracker_comment_torrent_timestamp ON Tracker_comment (torrent_id, timestamp);
@@ -0,0 +1,8 @@
+-- Backfills the denormalised stats of existing profiles (see UserProfile in models.py). Does nothing
+-- when syncdb creates the table. For a database from before these columns existed, add them (see
+-- "manage.py sqlall Tracker") and then run this file, e.g. "manage.py sqlcustom Tracker | manage.py dbshell".
+-- runshards resyncs seeding and leeching from the shards when it starts.
+UPDATE Tracker_userprofile SET
+    num_torrents = (SELECT COUNT(*) FROM Tracker_torrent WHERE Tracker_torrent.user_id = Tracker_userprofile.user_id),
+    seeding = (SELECT COUNT(*) FROM Tracker_peer WHERE Tracker_peer.user_id = Tracker_userprofile.user_id AND Tracker_peer.seeding = 1),
+    leeching = (SELECT COUNT(*) FROM Tracker_peer WHERE Tracker_peer.user_id = Tracker_userprofile.user_id AND Tracker_peer.seeding = 0);
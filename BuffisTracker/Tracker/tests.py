@@ -21,3 +21,491 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib
+import BuffisTracker.Tracker.announce
+import BuffisTracker.Tracker.views
+import BuffisTracker.Tracker.lib.bencode as bencode
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache, get_cache
+from django.http import HttpRequest, Http404
+from django.utils import simplejson
+from BuffisTracker.Tracker.models import *
+from BuffisTracker.Tracker.lib.shard import ShardServer, ShardClient, get_shard_paths, shard_for, run_shard
+from BuffisTracker.Tracker.lib.peertable import PeerTableWriter, PeerTableReader, peer_table_path
+from BuffisTracker.Tracker.lib.swarm import SwarmTable, LEECHER, SEEDER
+from BuffisTracker.Tracker.lib.snapshot import save_snapshot, load_snapshot, SnapshotError
+from BuffisTracker.Tracker.lib.history import History, HistoryTable, Counters, DROP_AFTER
+from BuffisTracker.Tracker.views import get_leaderboard
+from BuffisTracker.Tracker.management.commands.runhistory import DatabaseHistoryServer
+
+class ShardTest(TestCase):
+    """
+    Runs two shards in threads of the test process and announces through them. The shards also
+    write peer tables, which the announce view reads peers from.
+    """
+
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.paths = get_shard_paths(self.socket_dir, 2)
+        self.servers = [ShardServer(path, 30*60, self.socket_dir) for path in self.paths]
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.setDaemon(True)
+            thread.start()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.socket_dir)
+
+    def announce(self, client, info_hash, peer_id, left, event=""):
+        return client.announce(info_hash, peer_id, '\x7f\x00\x00\x01', 6881, left, event, 0, 0, 0, 50, True)
+
+    def test_routing(self):
+        client = ShardClient(self.paths)
+        hashes = ['\x00\x00\x00\x00' + 'a' * 16, '\x00\x00\x00\x01' + 'b' * 16]
+        for info_hash in hashes:
+            self.announce(client, info_hash, 'A' * 20, 100, "started")
+            self.announce(client, info_hash, 'B' * 20, 0)
+
+        for info_hash in hashes:
+            owner = self.servers[shard_for(info_hash, 2)]
+            other = self.servers[1 - shard_for(info_hash, 2)]
+            self.failUnless(info_hash in owner.swarms.swarms)
+            self.failIf(info_hash in other.swarms.swarms)
+
+        reply = self.announce(client, hashes[0], 'A' * 20, 100, "stopped")
+        self.failUnlessEqual((reply['complete'], reply['incomplete']), (1, 0))
+
+        # A swarm whose only peer stopped is dropped when sampled.
+        self.announce(client, hashes[0][:4] + 'x' * 16, 'A' * 20, 0, "stopped")
+
+        owner = self.servers[shard_for(hashes[0], 2)]
+        table_path = peer_table_path(self.socket_dir, hashes[0][:4] + 'x' * 16)
+        self.failUnless(os.path.exists(table_path))
+        owner.run_periodic(owner.next_sample)
+        self.failUnlessEqual(client.history(hashes[0])['minute']['seeders'], [1])
+        self.failUnlessEqual(client.history('\xff' * 20), {})
+        self.failIf(hashes[0][:4] + 'x' * 16 in owner.swarms.swarms)
+        self.failIf(os.path.exists(table_path))
+
+    def test_expire_when_sampled(self):
+        client = ShardClient(self.paths)
+        info_hash = '\x00\x00\x00\x00' + 'm' * 16
+        client.announce(info_hash, 'A' * 20, '\x7f\x00\x00\x01', 6881, 0, "started", 0, 0, 7, 0, True)
+
+        # Nobody announces to the torrent any more. Its peer expires when sampled and the empty swarm
+        # is dropped, the user of the peer is reported in the next announce to the shard.
+        owner = self.servers[shard_for(info_hash, 2)]
+        owner.run_periodic(time.time() + 3 * 30*60)
+        self.failIf(info_hash in owner.swarms.swarms)
+        reply = self.announce(client, info_hash[:4] + 'n' * 16, 'A' * 20, 0)
+        self.failUnlessEqual(reply['expired'], [[7, 1]])
+        self.failUnlessEqual(self.announce(client, info_hash[:4] + 'n' * 16, 'A' * 20, 0)['expired'], [])
+
+    def test_bad_input(self):
+        client = ShardClient(self.paths)
+        info_hash = 'd' * 20
+        reply = client.announce(info_hash, 'A' * 20, '\x7f\x00\x00\x01', 70000, 0, "", 0, 0, 0, 50, True)
+        self.failUnlessEqual(reply['failure reason'], 'invalid port')
+        reply = client.announce(info_hash, 'A' * 19, '\x7f\x00\x00\x01', 6881, 0, "", 0, 0, 0, 50, True)
+        self.failUnlessEqual(reply['failure reason'], 'invalid peer_id')
+        reply = client.announce(info_hash, 'A' * 20, '\x7f\x00\x00\x01', 6881, 0, "", 2**70, 0, 0, 50, True)
+        self.failUnlessEqual(reply['failure reason'], 'invalid uploaded')
+        self.failUnlessEqual(self.announce(client, info_hash, 'B' * 20, 0)['complete'], 1)
+
+        query = {'info_hash': 'd' * 20, 'peer_id': 'A' * 20, 'port': 6881, 'uploaded': 0, 'downloaded': 0, 'left': 0}
+        for key, value, error in (('port', 70000, 'invalid port'), ('peer_id', 'A' * 19, 'invalid peer id'),
+                ('uploaded', -1, 'invalid uploaded'), ('left', 2**64, 'invalid left')):
+            bad_query = dict(query, **{key: value})
+            response = self.client.get('/torrents/announce/', QUERY_STRING=urllib.urlencode(bad_query))
+            self.failUnlessEqual(bencode.bdecode(response.content)['failure reason'], error)
+
+    def test_timeouts(self):
+        # A shard that doesn't answer fails the request like one that isn't running.
+        path = os.path.join(self.socket_dir, 'stuck.sock')
+        stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stuck.bind(path)
+        stuck.listen(1)
+        try:
+            self.assertRaises(IOError, self.announce, ShardClient([path], 0.1), 'l' * 20, 'A' * 20, 0)
+        finally:
+            stuck.close()
+
+        # A worker that never sends its request doesn't keep the shard from answering the others.
+        server = self.servers[shard_for('l' * 20, 2)]
+        server.request_timeout = 0.1
+        silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        silent.connect(server.path)
+        try:
+            self.failUnlessEqual(self.announce(ShardClient(self.paths), 'l' * 20, 'A' * 20, 0)['complete'], 1)
+        finally:
+            silent.close()
+
+    def test_table_limit(self):
+        server = ShardServer(os.path.join(self.socket_dir, 'limited.sock'), 30*60, self.socket_dir, max_tables=1)
+        for info_hash in ('h' * 20, 'i' * 20):
+            server.dispatch({'op': 'announce', 'info_hash': info_hash, 'peer_id': 'A' * 20, 'ip': '\x7f\x00\x00\x01',
+                    'port': 6881, 'left': 0, 'event': '', 'uploaded': 0, 'downloaded': 0, 'user': 0,
+                    'numwant': 0, 'compact': 1})
+
+        # The least recently announced table is closed, readers can't use it any more.
+        self.failUnless(server.swarms.get('h' * 20).table is None)
+        self.assertRaises(ValueError, PeerTableReader, peer_table_path(self.socket_dir, 'h' * 20))
+        reader = PeerTableReader(peer_table_path(self.socket_dir, 'i' * 20))
+        self.failUnlessEqual(len(reader.get_random_peers(50)), 6)
+
+        # All tables are closed when the shard stops.
+        server.server_close()
+        self.failUnlessEqual(reader.get_random_peers(50), None)
+        reader.close()
+
+    def test_resync_user_counts(self):
+        user = User.objects.create(username='peer')
+        other = User.objects.create(username='gone')
+        UserProfile.objects.create(user=user, torrent_pass='y' * 32, seeding=5)
+        UserProfile.objects.create(user=other, torrent_pass='z' * 32, leeching=3)
+        client = ShardClient(self.paths)
+        for info_hash, left in (('\x00\x00\x00\x00' + 'j' * 16, 0), ('\x00\x00\x00\x01' + 'k' * 16, 10)):
+            client.announce(info_hash, 'A' * 20, '\x7f\x00\x00\x01', 6881, left, "started", 0, 0, user.id, 0, True)
+
+        settings.SWARM_SHARDS = 2
+        settings.SWARM_SOCKET_DIR = self.socket_dir
+        BuffisTracker.Tracker.announce._shard_client = None
+        try:
+            BuffisTracker.Tracker.announce.resync_user_counts()
+        finally:
+            settings.SWARM_SHARDS = BuffisTracker.Tracker.announce.DEFAULT_SWARM_SHARDS
+            settings.SWARM_SOCKET_DIR = BuffisTracker.Tracker.announce.DEFAULT_SWARM_SOCKET_DIR
+            BuffisTracker.Tracker.announce._shard_client = None
+
+        self.failUnlessEqual([(p.seeding, p.leeching) for p in UserProfile.objects.order_by('id')], [(1, 1), (0, 0)])
+
+    def test_announce_view(self):
+        client = RecordingShardClient(self.paths)
+        user = User.objects.create(username='uploader')
+        torrent = Torrent.objects.create(name='test', filename='test.torrent', user=user,
+                category=Category.objects.create(name='test'), info_hash=('c' * 20).encode('hex'))
+        query = {'info_hash': 'c' * 20, 'peer_id': 'A' * 20, 'port': 6881, 'uploaded': 0,
+                'downloaded': 0, 'left': 0, 'compact': 1}
+
+        settings.SWARM_SHARDS = 2
+        settings.SWARM_SOCKET_DIR = self.socket_dir
+        settings.PEER_TABLE_DIR = self.socket_dir
+        BuffisTracker.Tracker.announce._shard_client = client
+        try:
+            response = self.client.get('/torrents/announce/', QUERY_STRING=urllib.urlencode(query))
+
+            # Once the shard has a table open, peers are read from it and the shard sends none.
+            again = self.client.get('/torrents/announce/', QUERY_STRING=urllib.urlencode(query))
+            self.failUnlessEqual(client.replies[-1]['peers'], '')
+
+            # A writer that died halfway through a change leaves the generation odd. Readers give up
+            # and the peers are asked from the shard instead.
+            owner = self.servers[shard_for('c' * 20, 2)]
+            owner.swarms.get('c' * 20).table._begin()
+            stuck = self.client.get('/torrents/announce/', QUERY_STRING=urllib.urlencode(dict(query, peer_id='B' * 20)))
+        finally:
+            settings.SWARM_SHARDS = BuffisTracker.Tracker.announce.DEFAULT_SWARM_SHARDS
+            settings.SWARM_SOCKET_DIR = BuffisTracker.Tracker.announce.DEFAULT_SWARM_SOCKET_DIR
+            settings.PEER_TABLE_DIR = BuffisTracker.Tracker.announce.DEFAULT_PEER_TABLE_DIR
+            BuffisTracker.Tracker.announce._shard_client = None
+            BuffisTracker.Tracker.announce._peer_tables.clear()
+
+        reply = bencode.bdecode(response.content)
+        self.failUnlessEqual(reply['complete'], 1)
+        self.failUnlessEqual(reply['peers'], '\x7f\x00\x00\x01\x1a\xe1')
+        self.failUnlessEqual(bencode.bdecode(again.content)['peers'], reply['peers'])
+        self.failUnlessEqual(Torrent.objects.get(id=torrent.id).seeders, 2)
+        self.failUnlessEqual(len(bencode.bdecode(stuck.content)['peers']), 12)
+
+class RecordingShardClient(ShardClient):
+    def __init__(self, paths):
+        ShardClient.__init__(self, paths)
+        self.replies = []
+
+    def request_path(self, path, message):
+        reply = ShardClient.request_path(self, path, message)
+        self.replies.append(reply)
+        return reply
+
+def _announce_peers(paths, info_hashes, client_id, num_peers):
+    client = ShardClient(paths)
+    for info_hash in info_hashes:
+        for i in range(num_peers):
+            client.announce(info_hash, '%010d%010d' % (client_id, i), '\x7f\x00\x00\x01', 6881, i % 2, "", 0, 0, 0, 50, True)
+
+class ShardProcessTest(TestCase):
+    """
+    Runs the shards as separate processes, the way runshards does, with several client processes
+    announcing to them at the same time.
+    """
+
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.paths = get_shard_paths(self.socket_dir, 2)
+        self.snapshot_paths = get_shard_paths(self.socket_dir, 2, 'snapshot')
+        self.shards = [multiprocessing.Process(target=run_shard, args=(path, 30*60, None, snapshot_path))
+                for path, snapshot_path in zip(self.paths, self.snapshot_paths)]
+        for shard in self.shards:
+            shard.start()
+        deadline = time.time() + 10
+        while not all([os.path.exists(path) for path in self.paths]) and time.time() < deadline:
+            time.sleep(0.05)
+
+    def tearDown(self):
+        for shard in self.shards:
+            if shard.is_alive():
+                shard.terminate()
+                shard.join()
+        shutil.rmtree(self.socket_dir)
+
+    def test_concurrent_clients(self):
+        info_hashes = ['\x00\x00\x00\x00' + 'e' * 16, '\x00\x00\x00\x01' + 'f' * 16, '\x00\x00\x00\x02' + 'g' * 16]
+        clients = [multiprocessing.Process(target=_announce_peers, args=(self.paths, info_hashes, i, 10)) for i in range(4)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+            self.failUnlessEqual(client.exitcode, 0)
+
+        client = ShardClient(self.paths)
+        for info_hash in info_hashes:
+            reply = client.announce(info_hash, 'Z' * 20, '\x7f\x00\x00\x01', 6881, 0, "stopped", 0, 0, 0, 0, True)
+            self.failUnlessEqual((reply['complete'], reply['incomplete']), (20, 20))
+
+        # SIGTERM stops the shards cleanly, saving a final snapshot.
+        for shard in self.shards:
+            shard.terminate()
+            shard.join(10)
+            self.failUnlessEqual(shard.exitcode, 0)
+        for path in self.snapshot_paths:
+            self.failUnless(os.path.exists(path))
+
+class PeerTableTest(TestCase):
+    def setUp(self):
+        self.table_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.table_dir, 'test.peers')
+
+    def tearDown(self):
+        shutil.rmtree(self.table_dir)
+
+    def test_overflow(self):
+        writer = PeerTableWriter(self.path, capacity=2)
+        reader = PeerTableReader(self.path)
+        peers = {}
+        for i in range(3):
+            peers[str(i)] = ['\x0a\x00\x00%s' % chr(i), 6881, False, 0]
+            writer.update(str(i), *peers[str(i)])
+        self.failUnlessEqual(len(reader.get_random_peers(50)), 12)
+
+        # The held back peer takes the freed slot.
+        del peers['0']
+        writer.remove('0', peers)
+        self.failUnlessEqual(sorted(reader.get_random_peers(50)[3::6]), ['\x01', '\x02'])
+        self.failUnlessEqual(reader.get_random_peers(1)[4:], '\x1a\xe1')
+
+        writer.close()
+        reader.close()
+
+class SnapshotTest(TestCase):
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.snapshot_dir, 'shard-0.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_round_trip(self):
+        swarms = SwarmTable()
+        swarm = swarms.get('a' * 20)
+        swarm.announce('A' * 20, '\x7f\x00\x00\x01', 6881, 0, "completed", 100, 0, 0, 1000)
+        swarm.announce('B' * 20, '\x7f\x00\x00\x02', 6882, 10, "", 0, 50, 7, 5000)
+        histories = HistoryTable()
+        start = 1000 * 24*60*60
+        for now in range(start, start + 3 * 60 * 60, 60):
+            histories.sample(['a' * 20], swarms.swarms, now)
+        save_snapshot(swarms, self.path, 5000, histories=histories)
+
+        # Peer A is too old and is dropped, the accounting baseline of peer B is kept.
+        loaded = SwarmTable()
+        loaded_histories = HistoryTable()
+        self.failUnlessEqual(load_snapshot(loaded, self.path, 2000, histories=loaded_histories), 1)
+        self.failUnlessEqual(loaded_histories.get('a' * 20), histories.get('a' * 20))
+        self.failUnlessEqual(len(loaded_histories.get('a' * 20)['hour']['times']), 2)
+        swarm = loaded.get('a' * 20)
+        self.failUnlessEqual((swarm.seeders, swarm.leechers, swarm.downloads), (0, 1, 1))
+        self.failUnlessEqual(swarm.announce('B' * 20, '\x7f\x00\x00\x02', 6882, 0, "", 0, 80, 7, 6000), (0, 30, LEECHER, SEEDER))
+
+        # The owner of a torrent depends on the number of shards.
+        self.assertRaises(SnapshotError, load_snapshot, SwarmTable(), self.path, 2000, 2)
+
+    def test_failed_save(self):
+        swarms = SwarmTable()
+        swarms.get('a' * 20).announce('A' * 20, '\x7f\x00\x00\x01', 6881, 0, "", 0, 0, 0, 1000)
+        save_snapshot(swarms, self.path, 1000)
+        swarms.get('b' * 20).peers['B' * 20] = ['\x7f\x00\x00\x02', 6882, False, 1000, 2**70, 0, 0]
+
+        # The shard keeps serving, the old snapshot and no temporary file are left behind.
+        server = ShardServer(os.path.join(self.snapshot_dir, 'shard-0.sock'), 30*60, snapshot_path=self.path)
+        server.swarms = swarms
+        server.save_snapshot()
+        server.server_close()
+        self.failUnlessEqual(os.listdir(self.snapshot_dir), ['shard-0.snapshot'])
+        self.failUnlessEqual(load_snapshot(SwarmTable(), self.path, 0), 1)
+
+    def test_background_save(self):
+        server = ShardServer(os.path.join(self.snapshot_dir, 'shard-0.sock'), 30*60, snapshot_path=self.path)
+        server.swarms.get('a' * 20).announce('A' * 20, '\x7f\x00\x00\x01', 6881, 0, "", 0, 0, 0, int(time.time()))
+
+        # The snapshot is written by a child process, which is reaped between requests.
+        server.run_periodic(server.next_snapshot)
+        self.failIfEqual(server.snapshot_pid, None)
+        deadline = time.time() + 10
+        while server.snapshot_pid is not None and time.time() < deadline:
+            time.sleep(0.01)
+            server.run_periodic(0)
+        server.server_close()
+        self.failUnlessEqual(server.snapshot_pid, None)
+        self.failUnlessEqual(load_snapshot(SwarmTable(), self.path, 0), 1)
+
+class BencodeTest(TestCase):
+    def test_fast_paths(self):
+        for peers in ['\x7f\x00\x00\x01\x1a\xe1', [], [{"ip": "10.0.0.1", "port": 6881}],
+                [{"peer id": 'A' * 20, "ip": "10.0.0.1", "port": 6881}]]:
+            self.failUnlessEqual(bencode.bencode_announce(1800, 3, 4, peers),
+                    bencode.bencode({"interval": 1800, "complete": 3, "incomplete": 4, "peers": peers}))
+        self.failUnlessEqual(bencode.bencode_failure("no port"), bencode.bencode({"failure reason": "no port"}))
+
+class UserStatsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='uploader')
+        self.profile = UserProfile.objects.create(user=self.user, torrent_pass='x' * 32)
+        self.torrent = Torrent.objects.create(name='test', filename='test.torrent', user=self.user,
+                category=Category.objects.create(name='test'), info_hash=('c' * 20).encode('hex'))
+
+    def announce(self, **query):
+        query.update({'info_hash': 'c' * 20, 'peer_id': 'A' * 20, 'port': 6881})
+        self.client.get('/torrents/announce/%s/' % ('x' * 32), QUERY_STRING=urllib.urlencode(query))
+        return UserProfile.objects.get(id=self.profile.id)
+
+    def test_num_torrents(self):
+        self.failUnlessEqual(UserProfile.objects.get(id=self.profile.id).num_torrents, 1)
+        self.torrent.delete()
+        self.failUnlessEqual(UserProfile.objects.get(id=self.profile.id).num_torrents, 0)
+
+    def test_announce_counters(self):
+        profile = self.announce(uploaded=0, downloaded=0, left=100, event='started')
+        self.failUnlessEqual((profile.seeding, profile.leeching), (0, 1))
+        profile = self.announce(uploaded=300, downloaded=100, left=0, event='completed')
+        self.failUnlessEqual((profile.seeding, profile.leeching, profile.ratio), (1, 0, 3.0))
+        profile = self.announce(uploaded=300, downloaded=100, left=0, event='stopped')
+        self.failUnlessEqual((profile.seeding, profile.leeching), (0, 0))
+        self.failUnlessEqual(Peer.objects.count(), 0)
+
+    def test_leaderboard(self):
+        cache.delete('leaderboard')
+        self.announce(uploaded=300, downloaded=100, left=0, event='started')
+        self.announce(uploaded=600, downloaded=100, left=0)
+        leaderboard = get_leaderboard()
+        self.failUnlessEqual([e['username'] for e in leaderboard['top_uploaders']], ['uploader'])
+        self.failUnlessEqual([e['ratio'] for e in leaderboard['top_ratios']], [6.0])
+        cache.delete('leaderboard')
+
+class HistoryTest(TestCase):
+    def test_rollup(self):
+        history = History()
+        start = 1000 * 24*60*60 # Midnight.
+        for minute in range(25 * 60):
+            history.sample(start + minute * 60, minute // 60, 2, minute)
+        series = history.as_dict()
+
+        self.failUnlessEqual(len(series['minute']['times']), 120)
+        self.failUnlessEqual(series['minute']['times'][-1], start + (25 * 60 - 1) * 60)
+        self.failUnlessEqual(series['hour']['seeders'][:3], [0, 1, 2])
+        self.failUnlessEqual(series['hour']['downloads'][0], 59)
+        self.failUnlessEqual(series['day']['times'], [start])
+        self.failUnlessEqual((series['day']['seeders'], series['day']['downloads']), ([11], [23 * 60 + 59]))
+
+    def test_drop_inactive(self):
+        histories = HistoryTable()
+        counters = {'a' * 20: Counters(1, 0, 0), 'b' * 20: Counters(0, 0, 5)}
+        self.failUnlessEqual(histories.sample(counters.keys(), counters, 0), ['b' * 20])
+        self.failUnlessEqual(histories.get('b' * 20), None)
+
+        # The history of a torrent without peers is kept for DROP_AFTER seconds.
+        counters['a' * 20] = Counters(0, 0, 1)
+        self.failUnlessEqual(histories.sample(['a' * 20], counters, DROP_AFTER), [])
+        self.failUnlessEqual(histories.get('a' * 20)['minute']['seeders'], [1, 0])
+        self.failUnlessEqual(histories.sample(['a' * 20], counters, DROP_AFTER + 60), ['a' * 20])
+        self.failUnlessEqual(len(histories), 0)
+
+    def test_database_history(self):
+        user = User.objects.create(username='uploader')
+        Torrent.objects.create(name='test', filename='test.torrent', user=user, seeders=3, leechers=4,
+                category=Category.objects.create(name='test'), info_hash=('c' * 20).encode('hex'))
+        socket_dir = tempfile.mkdtemp()
+        try:
+            server = DatabaseHistoryServer(os.path.join(socket_dir, 'history.sock'), 30*60)
+            server.run_periodic(server.next_sample)
+            history = server.dispatch({'op': 'history', 'info_hash': 'c' * 20})['history']
+            self.failUnlessEqual((history['minute']['seeders'], history['minute']['leechers']), ([3], [4]))
+            self.failUnlessEqual(server.dispatch({'op': 'announce'}), {'failure reason': 'unknown op'})
+            server.server_close()
+        finally:
+            shutil.rmtree(socket_dir)
+
+class CommentTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('commenter', 'commenter@example.com', 'secret')
+        self.torrent = Torrent.objects.create(name='test', filename='test.torrent', user=self.user,
+                category=Category.objects.create(name='test'), info_hash=('c' * 20).encode('hex'))
+
+        # Comment pages are only cached with a backend shared between processes.
+        self.cache_dir = tempfile.mkdtemp()
+        self.old_cache_backend = settings.CACHE_BACKEND
+        settings.CACHE_BACKEND = 'file://%s' % self.cache_dir
+        BuffisTracker.Tracker.views.cache = get_cache(settings.CACHE_BACKEND)
+
+    def tearDown(self):
+        settings.CACHE_BACKEND = self.old_cache_backend
+        BuffisTracker.Tracker.views.cache = cache
+        shutil.rmtree(self.cache_dir)
+
+    def get_page(self, before=None):
+        query = before and {'before': before} or {}
+        return simplejson.loads(self.client.get('/torrents/comments/%d/' % self.torrent.id, query).content)
+
+    def test_paging(self):
+        for i in range(45):
+            Comment.objects.create(user=self.user, torrent=self.torrent, text='comment %d' % i)
+
+        texts = []
+        page = self.get_page()
+        while True:
+            texts.extend([c['text'] for c in page['comments']])
+            if not page['before']:
+                break
+            page = self.get_page(page['before'])
+        self.failUnlessEqual(texts, ['comment %d' % i for i in reversed(range(45))])
+
+    def test_post_invalidates_first_page(self):
+        self.failUnlessEqual(self.get_page()['comments'], [])
+        self.failIfEqual(BuffisTracker.Tracker.views.cache.get('comments:%d' % self.torrent.id), None)
+        self.client.login(username='commenter', password='secret')
+        self.client.post('/torrents/postcomment/%d/' % self.torrent.id, {'NewComment': 'first'})
+        self.failUnlessEqual([c['text'] for c in self.get_page()['comments']], ['first'])
+
+    def test_missing_torrent(self):
+        self.assertRaises(Http404, BuffisTracker.Tracker.views.torrent_detail, HttpRequest(), self.torrent.id + 1)
+        self.failUnlessEqual(BuffisTracker.Tracker.views.cache.get('comments:%d' % (self.torrent.id + 1)), None)
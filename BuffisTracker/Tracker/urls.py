@@ -3,18 +3,15 @@ from django.views.generic import list_detail
 from BuffisTracker.Tracker.models import *
 from BuffisTracker.Tracker.views import *
 
-torrent_dict = {
-        'queryset' : Torrent.objects.all(),
-        'template_name' : 'torrent_detail.html',
-        }
-
 urlpatterns = patterns('',
     # Main page for torrents.
     (r'^$', main_page),
 
     # View related to displaying and downloading a torrent.
-    (r'^torrent/(?P<object_id>\d+)/$', 'django.views.generic.list_detail.object_detail', torrent_dict),
+    (r'^torrent/(?P<object_id>\d+)/$', torrent_detail),
+    (r'^torrent/(?P<object_id>\d+)/history/$', torrent_history),
     (r'^postcomment/(?P<torrent_id>\d+)/$', post_comment),
+    (r'^comments/(?P<torrent_id>\d+)/$', torrent_comments),
     (r'^download/(?P<object_id>\d+)/$', download_torrent),
 
     # Listings
@@ -29,6 +26,7 @@ urlpatterns = patterns('',
 
     # Profile for torrent user.
     (r'^profile/$', profile),
+    (r'^leaderboard/$', leaderboard),
     
     # Announce for tracker.
     (r'^announce/(?P<torrent_pass>[^/]+)/$', announce),
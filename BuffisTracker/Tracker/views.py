@@ -1,11 +1,15 @@
 from django.shortcuts import get_object_or_404, render_to_response
-from socket import inet_aton
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponseRedirect, HttpResponse
 from django.template import RequestContext
+from django.core.cache import cache
+from django.utils import simplejson
 from django.forms import ModelForm
 from django.views.generic import list_detail
+from django.db.models import Q
 from BuffisTracker.Tracker.models import *
+from BuffisTracker.Tracker.announce import announce, get_history_client
 from django import forms
 import BuffisTracker.settings
 import BuffisTracker.Tracker.lib.bencode as bencode
@@ -15,8 +19,16 @@ import datetime
 DEFAULT_ANNOUNCE_URL = 'http://127.0.0.1:8000/torrents/announce/'
 DEFAULT_TORRENT_ROOT = '/tmp/'
 DEFAULT_TORRENTS_PER_PAGE = 30
-DEFAULT_TORRENT_INTERVAL = 30*60 # 30 minutes
-DEFAULT_TORRENT_MAX_REPLY_PEERS = 50
+DEFAULT_LEADERBOARD_SIZE = 10
+DEFAULT_LEADERBOARD_INTERVAL = 10*60 # 10 minutes
+DEFAULT_COMMENTS_PER_PAGE = 20
+DEFAULT_COMMENT_CACHE_TIMEOUT = 60*60 # 1 hour, the cached page is also dropped when a comment is posted.
+
+COMMENT_CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+# Cache backends shared by all worker processes. With a per process cache (such as the default
+# locmem) a comment posted through one worker would leave a stale first page in the others.
+SHARED_CACHE_SCHEMES = ('memcached', 'db', 'file')
 
 class TorrentForm(forms.Form):
     name = forms.CharField(max_length=100)
@@ -29,11 +41,18 @@ def make_new_torrent_pass():
     import random, string
     return "".join(random.sample(string.ascii_letters, 32))
 
-def get_random_peers(queryset, num_random):
-    import random
-    peers = list(queryset.all())
-    random.shuffle(peers)
-    return peers[:num_random]
+def get_user_profile(user):
+    """
+    Returns the UserProfile of a user, creating it if needed. A new profile starts with the number of
+    torrents the user has uploaded so far, after that it is kept up to date on upload and delete.
+    """
+
+    try:
+        return UserProfile.objects.get(user=user)
+    except UserProfile.DoesNotExist:
+        user_profile, created = UserProfile.objects.get_or_create(user=user, 
+                defaults={'torrent_pass' : make_new_torrent_pass(), 'num_torrents' : user.torrent_set.count()})
+        return user_profile
 
 def make_main_context_data():
     return {'top_tags' : Tag.objects.all(), 'categories' : Category.objects.all()}
@@ -59,7 +78,7 @@ def download_torrent(request, object_id):
 
     if request.user.is_authenticated():
         data = bencode.bdecode(local_file.read())
-        user_profile, created = UserProfile.objects.get_or_create(user=request.user, defaults={'torrent_pass' : make_new_torrent_pass()})
+        user_profile = get_user_profile(request.user)
         data["announce"] = str("%s%s/" % (announce_url, user_profile.torrent_pass))
         if "announce-list" in data:
             del data["announce-list"]
@@ -78,13 +97,109 @@ def profile(request):
     Displays the torrent profile of the user (seeded/leeched data and number of uploaded torrents).
     """
 
-    user_profile, _ = UserProfile.objects.get_or_create(user=request.user, defaults={'torrent_pass' : make_new_torrent_pass()})
+    user_profile = get_user_profile(request.user)
     extra_context = make_main_context_data()
     extra_context.update({'user' : request.user, 'profile' : user_profile})
     return render_to_response('torrent_profile.html',
             extra_context,
             context_instance=RequestContext(request))
 
+def make_comment_cursor(comment):
+    return "%s-%d" % (comment.timestamp.strftime(COMMENT_CURSOR_TIME_FORMAT), comment.id)
+
+def parse_comment_cursor(cursor):
+    """
+    Returns the (timestamp, id) of a cursor made by make_comment_cursor. Raises ValueError for invalid cursors.
+    """
+
+    timestamp, comment_id = cursor.split('-')
+    return datetime.datetime.strptime(timestamp, COMMENT_CURSOR_TIME_FORMAT), int(comment_id)
+
+def get_comments(torrent_id, before=None):
+    """
+    Returns a page of comments for a torrent, newest first, as a tuple of (comments, cursor).
+    Each comment is a dict of id, username, text and timestamp. The cursor is passed as before to 
+    get the next page of older comments, it is None on the last page.
+
+    The first page of every torrent is cached until a new comment is posted (see post_comment),
+    provided that CACHE_BACKEND is shared by the worker processes.
+    """
+
+    cache_key = 'comments:%d' % int(torrent_id)
+    use_cache = before is None and settings.CACHE_BACKEND.split(':', 1)[0] in SHARED_CACHE_SCHEMES
+    if use_cache:
+        page = cache.get(cache_key)
+        if page is not None:
+            return page
+
+    per_page = getattr(settings, 'COMMENTS_PER_PAGE', DEFAULT_COMMENTS_PER_PAGE)
+    queryset = Comment.objects.filter(torrent=torrent_id).select_related('user').order_by('-timestamp', '-id')
+    if before is not None:
+        timestamp, comment_id = parse_comment_cursor(before)
+        queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=comment_id))
+
+    # Fetch one extra comment to know if there is an older page.
+    comments = list(queryset[:per_page + 1])
+    if len(comments) > per_page:
+        cursor = make_comment_cursor(comments[per_page - 1])
+    else:
+        cursor = None
+    page = ([{'id' : c.id, 'username' : c.user.username, 'text' : c.text, 'timestamp' : c.timestamp} 
+        for c in comments[:per_page]], cursor)
+
+    if use_cache:
+        cache.set(cache_key, page, getattr(settings, 'COMMENT_CACHE_TIMEOUT', DEFAULT_COMMENT_CACHE_TIMEOUT))
+    return page
+
+def torrent_detail(request, object_id):
+    """
+    Displays a torrent and a page of its comments. Older comments are shown by setting the GET
+    attribute before to the cursor of the previous page.
+    Example: /torrents/torrent/3/?before=20100103120000000000-42
+    """
+
+    torrent = get_object_or_404(Torrent, id=object_id)
+    try:
+        comments, older_comments = get_comments(torrent.id, request.GET.get('before'))
+    except ValueError:
+        comments, older_comments = get_comments(torrent.id)
+
+    return render_to_response('torrent_detail.html',
+            {'object' : torrent, 'comments' : comments, 'older_comments' : older_comments},
+            context_instance=RequestContext(request))
+
+def torrent_comments(request, torrent_id):
+    """
+    Returns a page of comments for a torrent as JSON, for loading older comments incrementally.
+    Takes the same before GET attribute as torrent_detail, and returns the comments along with the
+    cursor for the next page (null on the last page).
+    """
+
+    torrent = get_object_or_404(Torrent, id=torrent_id)
+    try:
+        comments, cursor = get_comments(torrent.id, request.GET.get('before'))
+    except ValueError:
+        return HttpResponse(status=400)
+
+    comments = [dict(c, timestamp=c['timestamp'].strftime('%Y-%m-%d %H:%M:%S')) for c in comments]
+    return HttpResponse(simplejson.dumps({'comments' : comments, 'before' : cursor}), mimetype="application/json")
+
+def torrent_history(request, object_id):
+    """
+    Returns the seeders/leechers/downloads history of a torrent as JSON, with one series per 
+    resolution (minute, hour and day). Each series holds lists of times (unix timestamps), seeders, 
+    leechers and downloads. The history is kept by the shard owning the torrent, or by the runhistory
+    command if SWARM_SHARDS is not set. A torrent that hasn't had peers lately has no history and an
+    empty object is returned.
+    """
+
+    torrent = get_object_or_404(Torrent, id=object_id)
+    try:
+        history = get_history_client().history(torrent.info_hash.decode("hex"))
+    except (IOError, EOFError):
+        return HttpResponse(status=503)
+    return HttpResponse(simplejson.dumps(history), mimetype="application/json")
+
 @login_required
 def post_comment(request, torrent_id):
     """
@@ -96,6 +211,7 @@ def post_comment(request, torrent_id):
         new_comment = request.POST.get('NewComment', '')
         if new_comment:
             Comment(user=request.user, text=new_comment, torrent=torrent).save()
+            cache.delete('comments:%d' % torrent.id)
 
     return HttpResponseRedirect(torrent.get_absolute_url())
 
@@ -239,7 +355,42 @@ def torrents_for_user(request, username):
     """
 
     user = get_object_or_404(User, username=username)
-    return show_torrent_list(request, Torrent.objects.filter(user__username=username), "Listing torrents from user %s" % username)
+    return show_torrent_list(request, Torrent.objects.filter(user=user), "Listing torrents from user %s" % username)
+
+def get_leaderboard():
+    """
+    Returns the top uploaders and the top ratios. The lists are rebuilt at most once every 
+    LEADERBOARD_INTERVAL seconds and cached in between. Ratios are computed by the database while
+    sorting, so announces only have to keep uploaded and downloaded up to date.
+    """
+
+    leaderboard = cache.get('leaderboard')
+    if leaderboard is None:
+        size = getattr(BuffisTracker.settings, 'LEADERBOARD_SIZE', DEFAULT_LEADERBOARD_SIZE)
+        profiles = UserProfile.objects.select_related('user')
+
+        def entries(queryset):
+            return [{'username' : p.user.username, 'uploaded' : p.uploaded_readable, 
+                'downloaded' : p.downloaded_readable, 'ratio' : p.ratio} for p in queryset[:size]]
+
+        leaderboard = {
+                'top_uploaders' : entries(profiles.order_by('-uploaded')),
+                'top_ratios' : entries(profiles.filter(downloaded__gt=0).extra(
+                    select={'ratio_order' : 'uploaded * 1.0 / downloaded'}, order_by=['-ratio_order'])),
+                }
+        cache.set('leaderboard', leaderboard, getattr(BuffisTracker.settings, 'LEADERBOARD_INTERVAL', DEFAULT_LEADERBOARD_INTERVAL))
+    return leaderboard
+
+def leaderboard(request):
+    """
+    Displays the top uploaders and the users with the best ratios.
+    """
+
+    extra_context = make_main_context_data()
+    extra_context.update(get_leaderboard())
+    return render_to_response('torrent_leaderboard.html',
+            extra_context,
+            context_instance=RequestContext(request))
 
 def torrents_for_search(request):
     """
@@ -266,132 +417,3 @@ def torrents_for_tag(request, tag_name):
 
     tag = get_object_or_404(Tag, name=tag_name)
     return show_torrent_list(request, tag.torrent_set.all(), "Showing torrents with tag %s" % tag_name)
-
-def announce(request, torrent_pass=None):
-    """ 
-    The announcer for the tracker.
-    Requests to this is sent from torrent clients.
-    """
-
-    import cgi
-
-    def get_indata_error(data):
-        error = None
-        if not "info_hash" in get_data:
-            error = "no info hash"
-        elif not "peer_id" in get_data:
-            error = "no peer id"
-        elif not "port" in get_data:
-            error = "no port"
-        elif not "uploaded" in get_data:
-            error = "no uploaded"
-        elif not "downloaded" in get_data:
-            error = "no downloaded"
-        elif not "left" in get_data:
-            error = "no left"
-        return error
-
-    def make_error_response(error_msg):
-        response = bencode.bencode({"failure reason": error_msg}) 
-        return HttpResponse(response, mimetype="text/plain")
-
-    # Make sure that the torrent client sent a query string.
-    if request.META['QUERY_STRING']:
-        get_data = cgi.parse_qs(request.META['QUERY_STRING'])
-    else:
-        return make_error_response("No query string")
-
-    # Validate the torrents indata.
-    error = get_indata_error(get_data)
-    if error:
-        return make_error_response(error)
-
-    # Get users IP address.
-    ip = request.META['REMOTE_ADDR'] 
-
-    # Get the info hash of the torrent.
-    info_hash = get_data["info_hash"][0].encode("hex")
-
-    # Check if torrent exists.
-    try:
-        torrent = Torrent.objects.get(info_hash=info_hash)
-    except Torrent.DoesNotExist:
-        return make_error_response("No such torrent.")
-
-    # Check if a peer exists, otherwise create a new one.
-    peer_id = get_data["peer_id"][0].encode("hex")
-    peer, created = torrent.peers.get_or_create(peer_id = peer_id, defaults = {'ip' : ip, 'port' : int(get_data["port"][0])})
-
-    # True if the peer should be added to the peer list.
-    add_peer = True 
-
-    # Make peer into a seeder if he has all data.
-    if int(get_data["left"][0]) == 0:
-        peer.seeding = True
-        peer.save()
-
-    # Check if not just a regular call
-    if "event" in get_data:
-        event = get_data["event"][0]
-        if event == "started":
-            # reset uploaded / downloaded
-            peer.downloaded = 0
-            peer.uploaded = 0
-            peer.save()
-        elif event == "completed":
-            torrent.downloads += 1
-            torrent.save()
-        elif event == "stopped":
-            peer.delete()
-            add_peer = False
-
-    # Check if it is a registered user. Registered users are nice.
-    if torrent_pass:
-        try:
-            profile = UserProfile.objects.get(torrent_pass = torrent_pass)
-            profile.downloaded += int(get_data["downloaded"][0]) - peer.downloaded
-            profile.uploaded += int(get_data["uploaded"][0]) - peer.uploaded
-            profile.save()
-
-            peer.uploaded = get_data["uploaded"][0]
-            peer.downloaded = get_data["downloaded"][0]
-            peer.user = profile.user # Bind user to peer.
-            peer.save()
-        except UserProfile.DoesNotExist:
-            pass # Not a registered used, keep going.
-
-    # Remove peers that haven't been seen in TORRENT_INTERVAL*2 minutes.
-    torrent_interval = getattr(BuffisTracker.settings, 'TORRENT_INTERVAL', DEFAULT_TORRENT_INTERVAL)
-    torrent.peers.filter(seen__lt = datetime.datetime.now()-datetime.timedelta(seconds=torrent_interval*2)).delete()
-
-    # Add peer to peer list as long as he hasn't stopped.
-    if add_peer:
-        torrent.peers.add(peer)
-
-    # Update values for leechers and seeders.
-    torrent.leechers = torrent.peers.filter(seeding = False).count()
-    torrent.seeders = torrent.peers.filter(seeding = True).count()
-    torrent.save()
-
-    # Check if the client wants a specific number of peers, otherwise default to TORRENT_MAX_REPLY_PEERS.
-    if "numwant" in get_data and get_data["numwant"][0]: 
-        max_peers = int(get_data["numwant"][0])
-    else:
-        max_peers = getattr(BuffisTracker.settings, 'TORRENT_MAX_REPLY_PEERS', DEFAULT_TORRENT_MAX_REPLY_PEERS)
-
-    # Get a set of peers (randomized order) to return. Not using order_by='?' since it doesn't work with MySQL for
-    # large data sets,
-    peer_set = get_random_peers(torrent.peers, max_peers)
-
-    if "compact" in get_data and get_data["compact"][0]: # Compact response.
-        peers = "".join([inet_aton(str(p.ip)) + chr(p.port>>8) + chr(p.port&255) for p in peer_set]) 
-    else: # Normal response.
-        if "no_peer_id" in get_data and get_data["no_peer_id"][0]: # No peer_id in response.
-            peers = [{"ip": str(p.ip), "port": int(p.port)} for p in peer_set]
-        else: # Response with peer_id.
-            peers = [{"peer id": str(p.peer_id), "ip": str(p.ip), "port": int(p.port)} for p in peer_set]
-
-    # Bencode and send the response. 
-    response = bencode.bencode({"interval": torrent_interval, "complete": torrent.seeders, "incomplete": torrent.leechers, "peers": peers}) 
-    return HttpResponse(response, mimetype="text/plain")
-
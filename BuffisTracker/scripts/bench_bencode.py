@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""
+Compares the per-announce encode cost of bencode() and the bencode_announce/bencode_failure fast paths.
+
+Usage: python scripts/bench_bencode.py [number of peers]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import BuffisTracker.Tracker.lib.bencode as bencode
+
+def main():
+    num_peers = len(sys.argv) > 1 and int(sys.argv[1]) or 50
+    compact = os.urandom(6 * num_peers)
+    peer_dicts = [{"peer id": os.urandom(20), "ip": "10.0.0.%d" % (i % 256), "port": 6881} for i in range(num_peers)]
+    cases = [
+        ("compact, %d peers" % num_peers,
+            lambda: bencode.bencode({"interval": 1800, "complete": 12, "incomplete": 30, "peers": compact}),
+            lambda: bencode.bencode_announce(1800, 12, 30, compact)),
+        ("peer dicts, %d peers" % num_peers,
+            lambda: bencode.bencode({"interval": 1800, "complete": 12, "incomplete": 30, "peers": peer_dicts}),
+            lambda: bencode.bencode_announce(1800, 12, 30, peer_dicts)),
+        ("failure",
+            lambda: bencode.bencode({"failure reason": "No such torrent."}),
+            lambda: bencode.bencode_failure("No such torrent.")),
+    ]
+
+    print "%-24s %12s %12s %8s" % ("case", "bencode", "fast path", "speedup")
+    for name, generic, fast in cases:
+        assert generic() == fast()
+        number = 20000
+        generic_time = min(timeit.repeat(generic, number=number, repeat=3)) / number
+        fast_time = min(timeit.repeat(fast, number=number, repeat=3)) / number
+        print "%-24s %10.2fus %10.2fus %7.1fx" % (name, generic_time * 1e6, fast_time * 1e6, generic_time / fast_time)
+
+if __name__ == "__main__":
+    main()
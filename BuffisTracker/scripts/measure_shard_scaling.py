@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Measures how announce throughput of the sharded swarm mode scales with the number of shard
+processes. For every shard count, the shards are started as separate processes (like runshards does)
+and twice as many client processes announce random peers of random torrents to them over the Unix
+sockets. The database and the web server are left out, so this is the limit of the swarm layer only.
+
+Usage: python scripts/measure_shard_scaling.py [max shards] [announces per client]
+"""
+
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')))
+
+from BuffisTracker.Tracker.lib.shard import ShardClient, get_shard_paths, run_shard
+
+NUM_TORRENTS = 10000
+PEERS_PER_TORRENT = 20
+CLIENTS_PER_SHARD = 2
+
+def announce_loop(paths, num_announces, seed):
+    rand = random.Random(seed)
+    client = ShardClient(paths)
+    for i in xrange(num_announces):
+        torrent = rand.randrange(NUM_TORRENTS)
+        info_hash = ('%020d' % torrent)[::-1]
+        peer_id = '%010d%010d' % (torrent, rand.randrange(PEERS_PER_TORRENT))
+        client.announce(info_hash, peer_id, '\x7f\x00\x00\x01', 6881, rand.choice((0, 100)), "", 0, 0, 0, 50, True)
+
+def wait_for_sockets(paths, timeout=10):
+    deadline = time.time() + timeout
+    while not all([os.path.exists(path) for path in paths]):
+        if time.time() > deadline:
+            raise RuntimeError("shards did not start")
+        time.sleep(0.05)
+
+def measure(num_shards, num_announces):
+    """
+    Returns announces per second with num_shards shard processes.
+    """
+
+    socket_dir = tempfile.mkdtemp()
+    paths = get_shard_paths(socket_dir, num_shards)
+    shards = [multiprocessing.Process(target=run_shard, args=(path, 30*60)) for path in paths]
+    try:
+        for shard in shards:
+            shard.start()
+        wait_for_sockets(paths)
+
+        num_clients = num_shards * CLIENTS_PER_SHARD
+        clients = [multiprocessing.Process(target=announce_loop, args=(paths, num_announces, i))
+                for i in range(num_clients)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        return num_clients * num_announces / (time.time() - start)
+    finally:
+        for shard in shards:
+            shard.terminate()
+            shard.join()
+        shutil.rmtree(socket_dir)
+
+def main():
+    max_shards = len(sys.argv) > 1 and int(sys.argv[1]) or multiprocessing.cpu_count()
+    num_announces = len(sys.argv) > 2 and int(sys.argv[2]) or 5000
+    print "%d cpus, %d announces per client" % (multiprocessing.cpu_count(), num_announces)
+    print "%-8s %8s %14s %8s" % ("shards", "clients", "announces/s", "scaling")
+    base = None
+    num_shards = 1
+    while num_shards <= max_shards:
+        rate = measure(num_shards, num_announces)
+        base = base or rate
+        print "%-8d %8d %14.0f %7.2fx" % (num_shards, num_shards * CLIENTS_PER_SHARD, rate, rate / base)
+        num_shards *= 2
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Measures the startup time and memory of a worker process for the full site and for a tracker-only
+node (tracker_wsgi.py). Each configuration is started in a fresh process, which creates the WSGI
+handler and serves one announce so that the url configuration and views are loaded.
+
+Usage: python scripts/measure_startup.py [number of runs]
+"""
+
+import os
+import subprocess
+import sys
+
+PROJECT_PARENT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+CONFIGURATIONS = [
+    ('full site', 'BuffisTracker.settings'),
+    ('tracker only', 'BuffisTracker.tracker_settings'),
+]
+
+# Run in the child process. Prints the seconds until the first announce was served and the peak RSS in kB.
+CHILD = """
+import os, sys, time, resource
+from StringIO import StringIO
+start = time.time()
+os.environ['DJANGO_SETTINGS_MODULE'] = sys.argv[1]
+import django.core.handlers.wsgi
+handler = django.core.handlers.wsgi.WSGIHandler()
+environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/torrents/announce/', 'QUERY_STRING': '',
+        'REMOTE_ADDR': '127.0.0.1', 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+        'wsgi.input': StringIO(''), 'wsgi.errors': sys.stderr, 'wsgi.url_scheme': 'http'}
+body = ''.join(handler(environ, lambda status, headers: None))
+assert body.startswith('d14:failure reason'), body
+print time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, len(sys.modules)
+"""
+
+def measure(settings_module):
+    output = subprocess.Popen([sys.executable, '-c', CHILD, settings_module], cwd=PROJECT_PARENT,
+            env=dict(os.environ, PYTHONPATH=PROJECT_PARENT), stdout=subprocess.PIPE).communicate()[0]
+    seconds, rss, modules = output.split()
+    return float(seconds), int(rss), int(modules)
+
+def main():
+    runs = len(sys.argv) > 1 and int(sys.argv[1]) or 5
+    print "%-14s %14s %14s %10s" % ("configuration", "first announce", "peak RSS", "modules")
+    for name, settings_module in CONFIGURATIONS:
+        results = [measure(settings_module) for i in range(runs)]
+        seconds = min([r[0] for r in results])
+        rss = min([r[1] for r in results])
+        modules = results[0][2]
+        print "%-14s %12.1fms %12dkB %10d" % (name, seconds * 1000, rss, modules)
+
+if __name__ == "__main__":
+    main()
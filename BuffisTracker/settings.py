@@ -69,6 +69,10 @@ MIDDLEWARE_CLASSES = (
 
 ROOT_URLCONF = 'BuffisTracker.urls'
 
+# The comment pages are only cached with a cache shared by all web workers, such as
+# 'memcached://127.0.0.1:11211/'. The default cache is local to each worker process.
+CACHE_BACKEND = 'locmem://'
+
 TEMPLATE_DIRS = (
     # Put strings here, like "/home/html/django_templates" or "C:/www/django/templates".
     # Always use forward slashes, even on Windows.
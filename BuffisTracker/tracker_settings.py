@@ -0,0 +1,17 @@
+# Django settings for tracker-only nodes, used by tracker_wsgi.py.
+# Everything is taken from settings.py, except that only the announce urls are served and the
+# apps and middleware used by the rest of the site are left out. Tracker settings such as
+# SWARM_SHARDS or TORRENT_INTERVAL can be overridden below for the tracker nodes.
+
+from BuffisTracker.settings import *
+
+ROOT_URLCONF = 'BuffisTracker.tracker_urls'
+
+# Announces are not tied to sessions or logins (users are found through their torrent_pass).
+MIDDLEWARE_CLASSES = ()
+
+INSTALLED_APPS = (
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'BuffisTracker.Tracker',
+)
@@ -0,0 +1,8 @@
+from django.conf.urls.defaults import *
+from BuffisTracker.Tracker.announce import announce
+
+# Only the announce urls, at the same paths as on the full site.
+urlpatterns = patterns('',
+    (r'^torrents/announce/(?P<torrent_pass>[^/]+)/$', announce),
+    (r'^torrents/announce/$', announce),
+)
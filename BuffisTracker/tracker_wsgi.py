@@ -0,0 +1,9 @@
+# WSGI entry point for tracker-only nodes. Serves the announce urls without loading the admin,
+# forms, templates or auth views of the full site. Point the WSGI server at
+# BuffisTracker.tracker_wsgi:application, with the directory containing BuffisTracker on the path.
+
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'BuffisTracker.tracker_settings'
+
+import django.core.handlers.wsgi
+application = django.core.handlers.wsgi.WSGIHandler()